@@ -0,0 +1,74 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from panoptic_dataset_collector.utils.io import read_image
+from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+from panoptic_dataset_collector.utils.utils import valid_extension
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched model inference on CPU.")
+    parser.add_argument("--image_dir", help="Folder of images to annotate.", required=True)
+    parser.add_argument("--label_file", help="Yaml file with the categories.", required=True)
+    parser.add_argument("--sam_type", default="vit_b", type=str)
+    parser.add_argument("--images", default=16, type=int)
+    parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--threads", default=0, type=int)
+    parser.add_argument("--box_threshold", default=0.3, type=float)
+    parser.add_argument("--text_threshold", default=0.25, type=float)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    img_paths = sorted(
+        os.path.join(args.image_dir, name)
+        for name in os.listdir(args.image_dir)
+        if valid_extension(name)
+    )[: args.images]
+    image_arrays = [np.asarray(read_image(img_path, rgb=True)) for img_path in img_paths]
+    annotator = PanopticAnnotator(
+        tempfile.mkdtemp(), args.label_file, args.sam_type, batch_size=args.batch_size
+    )
+    bt, tt = args.box_threshold, args.text_threshold
+
+    # Warm up both paths so lazy initialization is not timed
+    annotator.predict_annotation(img_paths[0], bt, tt, image_arrays[0])
+    annotator.predict_annotations(img_paths[:2], bt, tt, image_arrays[:2])
+
+    start = time.perf_counter()
+    single = [
+        annotator.predict_annotation(img_path, bt, tt, image_array)
+        for img_path, image_array in zip(img_paths, image_arrays)
+    ]
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = annotator.predict_annotations(img_paths, bt, tt, image_arrays)
+    batched_time = time.perf_counter() - start
+
+    # Per image results must match single image mode
+    for single_labels, batched_labels in zip(single, batched):
+        assert single_labels["class_id"] == batched_labels["class_id"]
+        assert torch.allclose(single_labels["boxes"], batched_labels["boxes"], atol=1e-3)
+        if len(single_labels["masks"]):
+            agreement = (single_labels["masks"] == batched_labels["masks"]).float().mean()
+            assert agreement > 0.999, agreement
+
+    print(
+        f"images={len(img_paths)} batch_size={args.batch_size} "
+        f"threads={torch.get_num_threads()} sam={args.sam_type}"
+    )
+    print(f"single  {len(img_paths) / single_time:.2f} images/s")
+    print(
+        f"batched {len(img_paths) / batched_time:.2f} images/s "
+        f"({single_time / batched_time:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+
+from panoptic_dataset_collector.utils.io import write_json
+from panoptic_dataset_collector.utils.utils import combine_annotations_in_dir
+
+CATEGORIES = [{"name": "tiger"}, {"name": "elephant"}, {"name": "rhinoceros"}]
+
+
+# Function to write synthetic intermediate jsons like PanopticAnnotator._add_coco_segment
+def make_intermediate_jsons(json_dir: str, start: int, count: int):
+    for id in range(start, start + count):
+        img_id = f"image_{id:07d}"
+        segments_info = [
+            dict(id=k + 1, category_id=k % 3, bbox=[10, 20, 200, 300], iscrowd=0, area=51000)
+            for k in range(5)
+        ]
+        annotation = dict(
+            image_id=img_id, file_name=f"{img_id}.png", segments_info=segments_info
+        )
+        image_info = dict(id=img_id, file_name=f"{img_id}.jpg", width=1333, height=1000)
+        write_json(
+            os.path.join(json_dir, f"{img_id}.json"),
+            dict(annotations=[annotation], images=[image_info], categories=CATEGORIES),
+        )
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark merging intermediate jsons.")
+    parser.add_argument("--files", default=100000, type=int)
+    parser.add_argument("--new_files", default=1000, type=int)
+    parser.add_argument("--workers", default=0, type=int)
+    parser.add_argument("--validate", default=False, type=bool)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_dir = os.path.join(tmp_dir, "annotation_json")
+        final_json = os.path.join(tmp_dir, "panoptic_annotation.json")
+        os.makedirs(json_dir)
+        make_intermediate_jsons(json_dir, 0, args.files)
+        rss_before = peak_rss_mb()
+
+        start = time.perf_counter()
+        merged = combine_annotations_in_dir(json_dir, final_json, args.workers)
+        full_time = time.perf_counter() - start
+        print(f"full merge        {merged} files in {full_time:.2f}s")
+
+        make_intermediate_jsons(json_dir, args.files, args.new_files)
+        start = time.perf_counter()
+        merged = combine_annotations_in_dir(json_dir, final_json, args.workers)
+        incremental_time = time.perf_counter() - start
+        print(f"incremental merge {merged} files in {incremental_time:.2f}s")
+
+        print(f"peak rss {peak_rss_mb():.1f} MB (before merge {rss_before:.1f} MB)")
+        print(f"output {os.path.getsize(final_json) / 1e6:.1f} MB")
+        if args.validate:
+            with open(final_json) as f:
+                final = json.load(f)
+            assert len(final["annotations"]) == len(final["images"]) == merged + args.files
+            print("output is valid")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.overlap_resolution import make_masks
+from panoptic_dataset_collector.utils.io import save_ndarray_image
+from panoptic_dataset_collector.utils.utils import (
+    id2rgb,
+    mask_to_rle,
+    resolve_instance_overlaps,
+    rgb2id,
+)
+
+
+# Function with the png encoding of PanopticAnnotator._add_coco_segment before id2rgb
+def legacy_write(panoptic_path: str, panoptic_image: np.ndarray):
+    panoptic_image_id2rgb = np.zeros(panoptic_image.shape + (3,)).astype(np.uint8)
+    panoptic_image_id2rgb[:, :, 0] = panoptic_image
+    save_ndarray_image(panoptic_path, panoptic_image_id2rgb)
+
+
+def rle_write(json_path: str, panoptic_image: np.ndarray, valid_ids: list):
+    segments = [mask_to_rle(panoptic_image == id + 1) for id in valid_ids]
+    with open(json_path, "w") as f:
+        json.dump(segments, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark panoptic annotation writing.")
+    parser.add_argument("--instances", default=60, type=int)
+    parser.add_argument("--size", default=1333, type=int)
+    parser.add_argument("--repeats", default=5, type=int)
+    args = parser.parse_args()
+
+    masks = make_masks(args.instances, args.size, args.size)
+    panoptic_image, valid_ids = resolve_instance_overlaps(masks, 1000, 0.6)
+    out_dir = tempfile.mkdtemp()
+    outputs = dict(
+        legacy=(legacy_write, os.path.join(out_dir, "legacy.png"), (panoptic_image,)),
+        id2rgb=(
+            lambda path, image: save_ndarray_image(path, id2rgb(image)),
+            os.path.join(out_dir, "id2rgb.png"),
+            (panoptic_image,),
+        ),
+        rle=(rle_write, os.path.join(out_dir, "rle.json"), (panoptic_image, valid_ids)),
+    )
+
+    print(f"instances={args.instances} size={args.size}x{args.size} kept={len(valid_ids)}")
+    for name, (write, path, write_args) in outputs.items():
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            write(path, *write_args)
+        write_time = (time.perf_counter() - start) / args.repeats
+        # numpy reports its buffers to tracemalloc
+        tracemalloc.start()
+        write(path, *write_args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{name:<7} {write_time * 1000:.1f} ms peak={peak / 2**20:.1f} MB "
+            f"size={os.path.getsize(path) / 1024:.1f} KB"
+        )
+
+    # Ids below 256 are written as before, all ids survive the round trip
+    if panoptic_image.max() < 256:
+        assert np.array_equal(
+            np.asarray(Image.open(outputs["legacy"][1])),
+            np.asarray(Image.open(outputs["id2rgb"][1])),
+        )
+    assert np.array_equal(rgb2id(np.asarray(Image.open(outputs["id2rgb"][1]))), panoptic_image)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from panoptic_dataset_collector.utils.io import read_image
+from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+from panoptic_dataset_collector.utils.utils import valid_extension
+
+THRESHOLDS = [0.05, 0.1, 0.15, 0.2, 0.25, 0.3]
+
+
+# Prescreen recall is the share of the images annotated by the full models that pass it
+def main():
+    parser = argparse.ArgumentParser(description="Measure prescreen recall and skip rate.")
+    parser.add_argument("--image_dir", help="Folder of downloaded images.", required=True)
+    parser.add_argument("--label_file", help="Yaml file with the categories.", required=True)
+    parser.add_argument("--sam_type", default="vit_b", type=str)
+    parser.add_argument("--images", default=100, type=int)
+    parser.add_argument("--prescreen_size", default=400, type=int)
+    parser.add_argument("--box_threshold", default=0.3, type=float)
+    parser.add_argument("--text_threshold", default=0.25, type=float)
+    args = parser.parse_args()
+
+    img_paths = sorted(
+        os.path.join(args.image_dir, name)
+        for name in os.listdir(args.image_dir)
+        if valid_extension(name)
+    )[: args.images]
+    annotator = PanopticAnnotator(tempfile.mkdtemp(), args.label_file, args.sam_type)
+    bt, tt = args.box_threshold, args.text_threshold
+
+    scores, annotated = [], []
+    prescreen_time, full_time = 0.0, 0.0
+    for img_path in img_paths:
+        image_array = np.asarray(read_image(img_path, rgb=True))
+        start = time.perf_counter()
+        scores += annotator.runner.prescreen_scores(
+            [Image.fromarray(image_array)], annotator.prompt, args.prescreen_size
+        )
+        prescreen_time += time.perf_counter() - start
+        start = time.perf_counter()
+        image_labels = annotator.predict_annotation(img_path, bt, tt, image_array)
+        full_time += time.perf_counter() - start
+        annotated.append(len(image_labels["masks"]) > 0)
+    scores, annotated = np.array(scores), np.array(annotated)
+
+    print(
+        f"images={len(img_paths)} annotated={annotated.sum()} sam={args.sam_type} "
+        f"prescreen={1000 * prescreen_time / len(img_paths):.0f}ms/image "
+        f"full={1000 * full_time / len(img_paths):.0f}ms/image"
+    )
+    for threshold in THRESHOLDS:
+        passed = scores >= threshold
+        recall = passed[annotated].mean() if annotated.any() else 1.0
+        skipped = 1 - passed.mean()
+        saved = skipped * full_time - prescreen_time
+        print(
+            f"threshold={threshold:.2f} recall={recall:.3f} skipped={skipped:.1%} "
+            f"saved={saved:.1f}s of {full_time:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
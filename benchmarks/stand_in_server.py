@@ -0,0 +1,126 @@
+import functools
+import http.server
+import io
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+RESULTS_PER_PAGE = 10
+
+
+# Function to make a distinct smooth jpeg, distinct images keep the dedup index from rejecting them
+def make_jpeg(seed: int, size: Tuple[int, int], quality: int = 90) -> bytes:
+    rng = np.random.default_rng(seed)
+    image = Image.fromarray(rng.integers(0, 255, (8, 8, 3), dtype=np.uint8))
+    image = image.resize(size, Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, server_state: "StandInServer", *args, **kwargs):
+        self.state = server_state
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.state.latency)
+        parsed = urlparse(self.path)
+        self.state.count(parsed.path)
+        if parsed.path == "/customsearch/v1":
+            start = parse_qs(parsed.query).get("start", ["1"])[0]
+            self._send(200, "application/json", self.state.search_response(start))
+        elif parsed.path == "/robots.txt":
+            self._send(200, "text/plain", b"User-agent: *\nAllow: /\n")
+        elif parsed.path.startswith("/pages/"):
+            name = os.path.splitext(os.path.basename(parsed.path))[0]
+            self._send(200, "text/html", self.state.page(name))
+        elif parsed.path in self.state.images:
+            self._send(200, "image/jpeg", self.state.images[parsed.path])
+        else:
+            self._send(404, "text/plain", b"not found")
+
+
+class StandInServer:
+    def __init__(
+        self,
+        pages: int = 2,
+        deep_images: int = 2,
+        image_size: Tuple[int, int] = (1600, 1200),
+        latency: float = 0.02,
+    ):
+        # Serves the recorded search response, the pages of its hits and their images
+        self.latency = latency
+        self.deep_images = deep_images
+        with open(os.path.join(FIXTURES_PATH, "search_response.json"), "r") as f:
+            self.search_template = f.read()
+        self.start_ids = [start_id * RESULTS_PER_PAGE + 1 for start_id in range(pages)]
+        self.requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        # Images are encoded up front so serving them costs no cpu during a benchmark
+        self.images: Dict[str, bytes] = {}
+        for start_id in self.start_ids:
+            for id in range(RESULTS_PER_PAGE):
+                names = [f"{start_id}_{id}"]
+                names += [f"{start_id}_{id}_d{k}" for k in range(deep_images)]
+                for name in names:
+                    self.images[f"/images/{name}.jpg"] = make_jpeg(
+                        len(self.images), image_size
+                    )
+
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(_Handler, self)
+        )
+        self._server.daemon_threads = True
+        self.host = f"127.0.0.1:{self._server.server_address[1]}"
+        self.base_url = f"http://{self.host}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def search_response(self, start: str) -> bytes:
+        body = self.search_template.replace("{base}", self.base_url)
+        return body.replace("{host}", self.host).replace("{start}", start).encode()
+
+    # Function to get a hit page, it links to its extra images and to the next hit page
+    def page(self, name: str) -> bytes:
+        images = "".join(
+            f'<img src="/images/{name}_d{k}.jpg">' for k in range(self.deep_images)
+        )
+        return (
+            f'<html><body>{images}<a href="/pages/{name}.html">self</a></body></html>'.encode()
+        )
+
+    def count(self, path: str):
+        kind = path.split("/")[1] if path.count("/") > 1 else path
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def search_url(self) -> str:
+        return f"{self.base_url}/customsearch/v1"
+
+    def image_urls(self) -> List[str]:
+        return [f"{self.base_url}{path}" for path in self.images]
+
+    def __enter__(self) -> "StandInServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
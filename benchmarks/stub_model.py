@@ -0,0 +1,94 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.overlap_resolution import make_masks
+from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+from panoptic_dataset_collector.utils.utils import get_mask_bounds
+
+
+class StubRunner:
+    def __init__(
+        self,
+        label_names: List[str],
+        grounding_seconds: float = 0.05,
+        segmentation_seconds: float = 0.05,
+        instances: int = 20,
+    ):
+        # Fixed model costs and synthetic instances in place of GroundingDINO and SAM
+        self.label_names = label_names
+        self.grounding_seconds = grounding_seconds
+        self.segmentation_seconds = segmentation_seconds
+        self.instances = instances
+        self._masks: Dict[Tuple[int, int], np.ndarray] = {}
+
+    # Function to get the synthetic masks of an image size, generated once per size
+    def _synthetic_masks(self, height: int, width: int) -> np.ndarray:
+        if (height, width) not in self._masks:
+            self._masks[height, width] = make_masks(self.instances, height, width)
+        return self._masks[height, width]
+
+    def predict_boxes_batch(
+        self,
+        images_pil: List[Image.Image],
+        prompt: str,
+        box_threshold: float,
+        text_threshold: float,
+        image_hashes: Optional[List[Optional[str]]] = None,
+    ) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+        time.sleep(self.grounding_seconds * len(images_pil))
+        results = []
+        for image_pil in images_pil:
+            width, height = image_pil.size
+            bounds = get_mask_bounds(self._synthetic_masks(height, width))
+            boxes = torch.from_numpy(bounds[:, [2, 0, 3, 1]].astype(np.float32))
+            scores = torch.full((len(bounds),), 0.5)
+            phrases = [
+                self.label_names[id % len(self.label_names)] for id in range(len(bounds))
+            ]
+            results.append((boxes, scores, phrases))
+        return results
+
+    # Low resolution grounding costs about a quarter of the full pass
+    def prescreen_scores(
+        self,
+        images_pil: List[Image.Image],
+        prompt: str,
+        size: int,
+        image_hashes: Optional[List[Optional[str]]] = None,
+    ) -> List[float]:
+        time.sleep(self.grounding_seconds * len(images_pil) / 4)
+        return [0.5] * len(images_pil)
+
+    def embed_images(
+        self,
+        image_arrays: List[np.ndarray],
+        image_hashes: Optional[List[Optional[str]]] = None,
+    ) -> List[Dict]:
+        time.sleep(self.segmentation_seconds * len(image_arrays))
+        return [dict(shape=image_array.shape[:2]) for image_array in image_arrays]
+
+    def use_embedding(self, state: Dict):
+        self._shape = state["shape"]
+
+    def predict_masks(self, image_array: np.ndarray, boxes: torch.Tensor) -> torch.Tensor:
+        masks = self._synthetic_masks(*self._shape)
+        # Instances are reordered by class id, look them up by their boxes
+        bounds = get_mask_bounds(masks)[:, [2, 0, 3, 1]]
+        order = [
+            int(np.flatnonzero((bounds == box).all(axis=1))[0])
+            for box in boxes.numpy().astype(bounds.dtype)
+        ]
+        return torch.from_numpy(masks[order])
+
+
+class StubAnnotator(PanopticAnnotator):
+    def __init__(self, *args, stub_runner_args: Optional[Dict] = None, **kwargs):
+        self.stub_runner_args = stub_runner_args or {}
+        super().__init__(*args, **kwargs)
+
+    def _load_model(self, sam_type: str) -> StubRunner:
+        return StubRunner(self.label_names, **self.stub_runner_args)
@@ -0,0 +1,371 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from benchmarks.combine_annotations import make_intermediate_jsons
+from benchmarks.overlap_resolution import legacy_resolve, make_masks
+from benchmarks.stand_in_server import StandInServer
+from benchmarks.stub_model import StubAnnotator
+from panoptic_dataset_collector.utils.crawler import Crawler
+from panoptic_dataset_collector.utils.decoder import ImageDecoder
+from panoptic_dataset_collector.utils.dedup import DedupIndex
+from panoptic_dataset_collector.utils.filter import Filter
+from panoptic_dataset_collector.utils.frontier import FrontierCrawler
+from panoptic_dataset_collector.utils.http_client import HttpClient
+from panoptic_dataset_collector.utils.io import write_yaml
+from panoptic_dataset_collector.utils.pipeline import build_collection_pipeline
+from panoptic_dataset_collector.utils.utils import (
+    combine_annotations_in_dir,
+    resolve_instance_overlaps,
+)
+
+LABELS = ["tiger", "elephant", "rhinoceros"]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Function to summarize per item latencies in milliseconds
+def latency_stats(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return dict(p50_ms=0.0, p90_ms=0.0, p99_ms=0.0)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return dict(p50_ms=float(p50), p90_ms=float(p90), p99_ms=float(p99))
+
+
+# Function to time fn on every item with a thread pool, returns throughput and latencies
+def run_timed(fn: Callable, items: List, workers: int = 1) -> Dict:
+    latencies = []
+
+    def timed(item):
+        start = time.perf_counter()
+        result = fn(item)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(timed, items))
+    seconds = time.perf_counter() - start
+    return dict(
+        results=results,
+        items=len(items),
+        seconds=seconds,
+        items_per_sec=len(items) / seconds if seconds else 0.0,
+        **latency_stats(latencies),
+    )
+
+
+def make_label_file(work_dir: str) -> str:
+    label_file = os.path.join(work_dir, "labels.yaml")
+    write_yaml(
+        label_file, dict(categories=[dict(id=id, name=name) for id, name in enumerate(LABELS)])
+    )
+    return label_file
+
+
+def make_crawler(config: Dict, deep_search: bool) -> Crawler:
+    crawler = Crawler(
+        "benchmark",
+        "benchmark",
+        "safari in india",
+        False,
+        deep_search,
+        http_client=HttpClient(),
+        queries_per_second=1000.0,
+    )
+    crawler.url = config["search_url"]
+    crawler.frontier.domain_delay = 0.0
+    return crawler
+
+
+def make_filter(config: Dict, work_dir: str, decoder: bool = False) -> Filter:
+    return Filter(
+        False,
+        work_dir,
+        max_workers=config["fetch_workers"],
+        max_in_flight=2 * config["fetch_workers"],
+        dedup_index=DedupIndex(os.path.join(work_dir, "dedup_index.jsonl")),
+        decoder=ImageDecoder(config["decode_workers"]) if decoder else None,
+    )
+
+
+def make_annotator(config: Dict, work_dir: str) -> StubAnnotator:
+    return StubAnnotator(
+        work_dir,
+        make_label_file(work_dir),
+        batch_size=config["batch_size"],
+        visualize=False,
+        stub_runner_args=dict(
+            grounding_seconds=config["grounding_ms"] / 1000,
+            segmentation_seconds=config["segmentation_ms"] / 1000,
+            instances=config["instances"],
+        ),
+    )
+
+
+def bench_search(config: Dict, work_dir: str) -> Dict:
+    crawler = make_crawler(config, deep_search=False)
+    metrics = run_timed(crawler.crawl, config["start_ids"])
+    urls = sum(len(urls) for urls in metrics.pop("results"))
+    return dict(metrics, urls=urls)
+
+
+def bench_deep_crawl(config: Dict, work_dir: str) -> Dict:
+    crawler = make_crawler(config, deep_search=False)
+    frontier = FrontierCrawler(crawler.http_client, max_depth=1, domain_delay=0.0)
+    page_urls = [
+        [item["image"]["contextLink"] for item in crawler.search(start_id)["items"]]
+        for start_id in config["start_ids"]
+    ]
+    metrics = run_timed(lambda urls: list(frontier.crawl(urls)), page_urls)
+    urls = sum(len(urls) for urls in metrics.pop("results"))
+    return dict(metrics, urls=urls)
+
+
+def bench_fetch(config: Dict, work_dir: str) -> Dict:
+    filter = make_filter(config, work_dir)
+    metrics = run_timed(filter.download_image, config["image_urls"], config["fetch_workers"])
+    downloaded = sum(img_path != "" for img_path in metrics.pop("results"))
+    return dict(metrics, downloaded=downloaded)
+
+
+def bench_decode(config: Dict, work_dir: str) -> Dict:
+    filter = make_filter(config, work_dir, decoder=True)
+    img_paths = [filter.download_image(url) for url in config["image_urls"]]
+    # Start the decode processes before timing
+    filter.decoder.decode(img_paths[0], filter.min_size, filter.max_size)
+    metrics = run_timed(filter.decode_image, img_paths, config["decode_workers"])
+    valid = sum(image_array is not None for image_array in metrics.pop("results"))
+    filter.decoder.close()
+    return dict(metrics, valid=valid)
+
+
+def bench_overlap(config: Dict, work_dir: str) -> Dict:
+    masks = [
+        make_masks(config["instances"], config["mask_size"], config["mask_size"], seed)
+        for seed in range(config["mask_images"])
+    ]
+    legacy = run_timed(lambda image_masks: legacy_resolve(image_masks, 1000, 0.6), masks)
+    legacy.pop("results")
+    metrics = run_timed(
+        lambda image_masks: resolve_instance_overlaps(image_masks, 1000, 0.6), masks
+    )
+    metrics.pop("results")
+    return dict(metrics, legacy=legacy)
+
+
+def bench_write(config: Dict, work_dir: str) -> Dict:
+    annotator = make_annotator(config, work_dir)
+    size = config["mask_size"]
+    image_array = np.zeros((size, size, 3), dtype=np.uint8)
+    img_paths = []
+    for id in range(config["mask_images"]):
+        img_path = os.path.join(work_dir, f"image_{id}.jpg")
+        open(img_path, "wb").close()
+        img_paths.append(img_path)
+    image_labels = annotator.predict_annotations(
+        img_paths, 0.3, 0.25, [image_array] * len(img_paths)
+    )
+    metrics = run_timed(annotator.write_annotation, image_labels)
+    metrics.pop("results")
+    return metrics
+
+
+def bench_merge(config: Dict, work_dir: str) -> Dict:
+    json_dir = os.path.join(work_dir, "annotation_json")
+    os.makedirs(json_dir)
+    make_intermediate_jsons(json_dir, 0, config["merge_files"])
+    start = time.perf_counter()
+    merged = combine_annotations_in_dir(json_dir, os.path.join(work_dir, "merged.json"))
+    seconds = time.perf_counter() - start
+    return dict(items=merged, seconds=seconds, items_per_sec=merged / seconds)
+
+
+def bench_end_to_end(config: Dict, work_dir: str) -> Dict:
+    crawler = make_crawler(config, deep_search=config["deep_images"] > 0)
+    crawler.frontier.max_depth = 1
+    filter = make_filter(config, work_dir, decoder=True)
+    annotator = make_annotator(config, work_dir)
+    pipeline = build_collection_pipeline(
+        crawler,
+        filter,
+        annotator,
+        0.3,
+        0.25,
+        fetch_workers=config["fetch_workers"],
+        decode_workers=config["decode_workers"],
+    )
+    start = time.perf_counter()
+    annotated = sum(1 for _ in pipeline.run(config["start_ids"]))
+    seconds = time.perf_counter() - start
+    annotator.combine_all_annotations()
+    annotator.close()
+    filter.decoder.close()
+    stages = {}
+    for stage in pipeline.stages:
+        latencies = stage.stats.latencies
+        stages[stage.name] = dict(
+            items=stage.stats.items_in, errors=stage.stats.errors, **latency_stats(latencies)
+        )
+    return dict(
+        items=annotated, seconds=seconds, items_per_sec=annotated / seconds, stages=stages
+    )
+
+
+SUBSYSTEMS = dict(
+    search=bench_search,
+    deep_crawl=bench_deep_crawl,
+    fetch=bench_fetch,
+    decode=bench_decode,
+    overlap=bench_overlap,
+    write=bench_write,
+    merge=bench_merge,
+    end_to_end=bench_end_to_end,
+)
+
+
+# Function to run one subsystem in a fresh process so its peak rss is its own
+def _run_subsystem(name: str, config: Dict, results: multiprocessing.Queue):
+    with tempfile.TemporaryDirectory() as work_dir:
+        metrics = SUBSYSTEMS[name](config, work_dir)
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    results.put(metrics)
+
+
+# Function to run a subsystem, a subsystem that crashes or times out is reported with an error
+def run_subsystem(name: str, config: Dict, timeout: float) -> Dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_subsystem, args=(name, config, results))
+    process.start()
+    deadline = time.time() + timeout
+    metrics = None
+    while metrics is None and time.time() < deadline:
+        # A process that died leaves nothing in the queue, so it is polled rather than awaited
+        alive = process.is_alive()
+        try:
+            metrics = results.get(timeout=1)
+        except queue.Empty:
+            if not alive:
+                break
+    timed_out = metrics is None and process.is_alive()
+    if timed_out:
+        process.terminate()
+    process.join()
+    if timed_out:
+        return dict(error=f"timed out after {timeout:.0f}s")
+    if metrics is None:
+        return dict(error=f"exited with code {process.exitcode}")
+    return metrics
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+# Function to print the throughput and latency changes against a previous result file
+def compare(results: Dict, baseline_file: str):
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    print(f"compared to {baseline.get('commit', '')} ({baseline_file})")
+    for name, metrics in results["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        changes = []
+        for key in ["items_per_sec", "p50_ms", "p99_ms", "peak_rss_mb"]:
+            if previous.get(key) and key in metrics:
+                changes.append(f"{key} {metrics[key] / previous[key]:.2f}x")
+        print(f"  {name:<11} " + " ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark suite.")
+    parser.add_argument("--subsystems", default=",".join(SUBSYSTEMS), type=str)
+    parser.add_argument("--pages", default=2, type=int)
+    parser.add_argument("--deep_images", default=1, type=int)
+    parser.add_argument("--image_width", default=1600, type=int)
+    parser.add_argument("--image_height", default=1200, type=int)
+    parser.add_argument("--latency_ms", default=20.0, type=float)
+    parser.add_argument("--fetch_workers", default=16, type=int)
+    parser.add_argument("--decode_workers", default=2, type=int)
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--grounding_ms", default=50.0, type=float)
+    parser.add_argument("--segmentation_ms", default=50.0, type=float)
+    parser.add_argument("--instances", default=20, type=int)
+    parser.add_argument("--mask_size", default=800, type=int)
+    parser.add_argument("--mask_images", default=5, type=int)
+    parser.add_argument("--merge_files", default=2000, type=int)
+    parser.add_argument(
+        "--timeout",
+        help="Seconds a subsystem may run before it fails.",
+        default=1800,
+        type=float,
+    )
+    parser.add_argument("--output", help="Json file to write the results to.", default="")
+    parser.add_argument("--compare", help="Previous results json to compare.", default="")
+    args = parser.parse_args()
+
+    config = vars(args).copy()
+    with StandInServer(
+        args.pages,
+        args.deep_images,
+        (args.image_width, args.image_height),
+        args.latency_ms / 1000,
+    ) as server:
+        config.update(
+            search_url=server.search_url(),
+            start_ids=server.start_ids,
+            image_urls=server.image_urls(),
+        )
+        results = dict(
+            commit=git_commit(), timestamp=time.time(), config=vars(args), results={}
+        )
+        failed = []
+        for name in args.subsystems.split(","):
+            metrics = run_subsystem(name, config, args.timeout)
+            results["results"][name] = metrics
+            if "error" in metrics:
+                failed.append(name)
+                print(f"{name:<11} failed, {metrics['error']}")
+                continue
+            line = f"{name:<11} {metrics['items']:>5} items {metrics['items_per_sec']:9.2f}/s"
+            if "p50_ms" in metrics:
+                line += f" p50={metrics['p50_ms']:.1f}ms p99={metrics['p99_ms']:.1f}ms"
+            print(f"{line} rss={metrics['peak_rss_mb']:.0f}MB")
+            for stage, stage_metrics in metrics.get("stages", {}).items():
+                print(
+                    f"  {stage:<9} {stage_metrics['items']:>5} items "
+                    f"p50={stage_metrics['p50_ms']:.1f}ms p90={stage_metrics['p90_ms']:.1f}ms "
+                    f"p99={stage_metrics['p99_ms']:.1f}ms"
+                )
+        results["requests"] = server.requests
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    if failed:
+        raise SystemExit(f"Failed subsystems: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import argparse
+import os
+
+from panoptic_dataset_collector.utils.shards import ShardReader
+
+
+# Main function
+def main():
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description="Unpack a sharded dataset into the COCO panoptic folder layout."
+    )
+    parser.add_argument(
+        "--dataset",
+        help="Dataset folder collected with --output_format shards",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--output",
+        help="Folder to write images, panoptic pngs and the COCO json to",
+        type=str,
+        required=True,
+    )
+    args = parser.parse_args()
+
+    reader = ShardReader(os.path.join(args.dataset, "shards"))
+    if len(reader) == 0:
+        raise RuntimeError(f"No sharded samples in {args.dataset}")
+    images = reader.export_coco(args.output)
+    print(f"Exported {images} images to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
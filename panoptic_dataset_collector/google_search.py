@@ -1,9 +1,24 @@
 import argparse
 import os
+import threading
 
+from panoptic_dataset_collector.utils.annotation_pool import AnnotationPool
 from panoptic_dataset_collector.utils.crawler import Crawler
+from panoptic_dataset_collector.utils.decoder import ImageDecoder
+from panoptic_dataset_collector.utils.dedup import DedupIndex
 from panoptic_dataset_collector.utils.filter import Filter
-from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+from panoptic_dataset_collector.utils.http_client import HttpClient
+from panoptic_dataset_collector.utils.manifest import RunManifest
+from panoptic_dataset_collector.utils.metrics import MetricsReporter, get_metrics
+from panoptic_dataset_collector.utils.panoptic_annotator import (
+    MASK_FORMATS,
+    OUTPUT_FORMATS,
+    SAM_TYPES,
+    PanopticAnnotator,
+)
+from panoptic_dataset_collector.utils.pipeline import build_collection_pipeline
+from panoptic_dataset_collector.utils.profiler import HotPathProfiler
+from panoptic_dataset_collector.utils.search_cache import SearchCache
 
 
 # Main function
@@ -55,6 +70,7 @@ def main():
         "--sam_type",
         help="Type of SAM to use [vit_h, vit_l, vit_b]. vit_h is GPU memory intensive but accurate.",
         default="vit_l",
+        choices=SAM_TYPES,
         type=str,
     )
     parser.add_argument(
@@ -69,27 +85,310 @@ def main():
         default=0.25,
         type=float,
     )
+    parser.add_argument(
+        "--download_workers",
+        help="Number of concurrent image downloads.",
+        default=16,
+        type=int,
+    )
+    parser.add_argument(
+        "--download_timeout",
+        help="Timeout in seconds for each image request.",
+        default=10.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--max_retries",
+        help="Number of retries with exponential backoff for failed requests.",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--feature_cache_mb",
+        help="Size cap of the on-disk image feature cache in MB, e.g. 4096 to rerun threshold "
+        "sweeps on the same images without the image encoders. 0 disables it.",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--clear_feature_cache",
+        help="Invalidate the image feature cache before annotating",
+        default=False,
+        type=bool,
+    )
+    parser.add_argument(
+        "--decode_workers",
+        help="Number of processes decoding, validating and resizing downloaded images.",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--dedup_distance",
+        help="Max hamming distance of perceptual hashes for near-duplicate images.",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--deep_search_depth",
+        help="Max link depth followed from each page by deep search.",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--deep_search_pages",
+        help="Max pages fetched per website by deep search.",
+        default=50,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_queries",
+        help="Max number of paid search api queries for this run, cached pages are free.",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--search_cache_ttl",
+        help="Hours a cached search api response stays valid.",
+        default=7 * 24,
+        type=float,
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="Number of annotation processes, each loading its own model.",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--torch_threads",
+        help="Torch threads per annotation process, 0 splits the cores between processes.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="Number of images annotated per model call, with a single annotation process.",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch_latency",
+        help="Max seconds to wait for a full batch before annotating a partial one.",
+        default=0.5,
+        type=float,
+    )
+    parser.add_argument(
+        "--mask_format",
+        help="Write panoptic pngs or RLE masks in the annotation json.",
+        default="png",
+        choices=MASK_FORMATS,
+        type=str,
+    )
+    parser.add_argument(
+        "--output_format",
+        help="Write a file per image and output, or pack them into tar shards.",
+        default="files",
+        choices=OUTPUT_FORMATS,
+        type=str,
+    )
+    parser.add_argument(
+        "--shard_size_mb",
+        help="Size in MB at which a new shard is started.",
+        default=1024,
+        type=float,
+    )
+    parser.add_argument(
+        "--async_write",
+        help="Write annotation outputs in a background thread, with a single annotation "
+        "process.",
+        default=False,
+        type=bool,
+    )
+    parser.add_argument(
+        "--memory_budget_mb",
+        help="Free unused model memory only once a process uses more MB, 0 never frees it.",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--prescreen_threshold",
+        help="Skip the full models on images whose best box in a low resolution grounding "
+        "pass scores below this, lower keeps more images. 0 disables the prescreen.",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--prescreen_size",
+        help="Shorter image side of the prescreen grounding pass.",
+        default=400,
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        help="Seconds between metrics reports in the dataset folder, 0 reports at the end only.",
+        default=30,
+        type=float,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the annotation hot path and write the profiles to the dataset folder.",
+        default=False,
+        type=bool,
+    )
     args = parser.parse_args()
+    # Annotation processes annotate and write one image per call
+    if args.num_workers > 1 and (args.batch_size > 1 or args.async_write):
+        parser.error("--batch_size and --async_write need --num_workers 1")
 
     download_folder = os.path.join(
         os.getcwd(), "panoptic_dataset_collector", "datasets", args.search.replace(" ", "_")
     )
+    # Re-running the same search resumes from the manifest in the dataset folder
+    manifest = RunManifest(download_folder)
+    print(f"Run manifest: {manifest.summary()}")
+    http_client = HttpClient(
+        timeout=args.download_timeout,
+        max_retries=args.max_retries,
+        pool_maxsize=args.download_workers,
+    )
     crawler = Crawler(
-        args.api_key, args.engine_id, args.search, args.commercial_only, args.deep_search
+        args.api_key,
+        args.engine_id,
+        args.search,
+        args.commercial_only,
+        args.deep_search,
+        http_client=http_client,
+        max_depth=args.deep_search_depth,
+        max_pages=args.deep_search_pages,
+        search_cache=SearchCache(
+            os.path.join(os.path.dirname(download_folder), ".search_cache"),
+            args.search_cache_ttl * 3600,
+        ),
+        max_queries=args.max_queries,
     )
-    filter = Filter(args.commercial_only, download_folder)
-    annotator = PanopticAnnotator(download_folder, args.label_file, args.sam_type)
     # Google search allows only 10 searches per call
     # Loop by changing the start index
     results_per_page = 10
     start_index = 1
     end_index = args.search_pages * results_per_page + start_index
-    for start_id in range(start_index, end_index, results_per_page):
-        image_urls = crawler.crawl(start_id)
-        image_paths = filter.filter_and_download_images(image_urls)
-        for pth in image_paths:
-            annotator.generate_annotation(pth, args.box_threshold, args.text_threshold)
+    # Search pages not completed by a previous run are fetched while the model loads
+    start_ids = list(range(start_index, end_index, results_per_page))
+    crawler.prefetch([start_id for start_id in start_ids if manifest.page(start_id) is None])
+    filter = Filter(
+        args.commercial_only,
+        download_folder,
+        max_workers=args.download_workers,
+        max_in_flight=2 * args.download_workers,
+        timeout=args.download_timeout,
+        http_client=http_client,
+        dedup_index=DedupIndex(
+            os.path.join(download_folder, "dedup_index.jsonl"), args.dedup_distance
+        ),
+        decoder=ImageDecoder(args.decode_workers),
+    )
+    if args.num_workers > 1:
+        # Every worker process loads its own model and writes its own outputs
+        annotator = AnnotationPool(
+            download_folder,
+            args.label_file,
+            args.sam_type,
+            args.feature_cache_mb,
+            args.num_workers,
+            args.torch_threads,
+            args.mask_format,
+            args.memory_budget_mb,
+            args.prescreen_threshold,
+            args.prescreen_size,
+            args.output_format,
+            args.shard_size_mb,
+        )
+    else:
+        annotator = PanopticAnnotator(
+            download_folder,
+            args.label_file,
+            args.sam_type,
+            args.feature_cache_mb,
+            args.batch_size,
+            args.mask_format,
+            args.async_write,
+            args.memory_budget_mb,
+            # Models load while the first pages are crawled and downloaded
+            background_load=True,
+            prescreen_threshold=args.prescreen_threshold,
+            prescreen_size=args.prescreen_size,
+            output_format=args.output_format,
+            shard_size_mb=args.shard_size_mb,
+        )
+    if args.clear_feature_cache:
+        annotator.clear_feature_cache()
+
+    # Stage timings and rejection counts are reported as json lines and in Prometheus format
+    def gauges():
+        values = {
+            f"http_{name}": value for name, value in http_client.timings.summary().items()
+        }
+        values.update(
+            {f"search_{name}": value for name, value in crawler.search_stats().items()}
+        )
+        if args.num_workers == 1 and annotator.runtime is not None:
+            values.update(annotator.runtime.stats())
+        return values
+
+    reporter = MetricsReporter(
+        get_metrics(),
+        os.path.join(download_folder, "metrics.jsonl"),
+        os.path.join(download_folder, "metrics.prom"),
+        args.metrics_interval,
+        gauges=gauges,
+    )
+    reporter.start()
+    # Annotation pool workers run in other processes and are not profiled
+    profiler = None
+    if args.profile:
+        profiler = HotPathProfiler(os.path.join(download_folder, "profile"))
+    # Crawling, downloading and annotation of different pages overlap
+    pipeline = build_collection_pipeline(
+        crawler,
+        filter,
+        annotator,
+        args.box_threshold,
+        args.text_threshold,
+        fetch_workers=args.download_workers,
+        decode_workers=args.decode_workers,
+        manifest=manifest,
+        max_batch_latency=args.batch_latency,
+        profiler=profiler,
+    )
+    if args.num_workers == 1:
+        # A failed background model load stops the run instead of failing every batch
+        def stop_on_load_error():
+            try:
+                annotator.wait_for_model()
+            except RuntimeError:
+                pipeline.stop()
+
+        threading.Thread(target=stop_on_load_error, daemon=True).start()
+    for _ in pipeline.run(start_ids):
+        pass
+    filter.decoder.close()
+    if args.num_workers == 1:
+        # Raises the load error, so the run exits with an error status
+        try:
+            annotator.wait_for_model()
+        except RuntimeError:
+            annotator.close()
+            reporter.close()
+            raise
     annotator.combine_all_annotations()
+    annotator.close()
+    print(pipeline.summary())
+    print(f"HTTP timings: {http_client.timings.summary()}")
+    print(f"Search api: {crawler.search_stats()}")
+    reporter.close()
+    print(get_metrics().summary())
+    if args.num_workers == 1 and args.prescreen_threshold > 0:
+        print(annotator.prescreen_summary())
+    if profiler is not None:
+        print(profiler.dump())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import argparse
+import os
+
+from panoptic_dataset_collector.utils.batch import (
+    merge_datasets,
+    read_queries,
+    submit_queries,
+    wait_for_jobs,
+)
+from panoptic_dataset_collector.utils.crawler import SearchQuota
+from panoptic_dataset_collector.utils.dedup import DedupIndex
+from panoptic_dataset_collector.utils.http_client import HttpClient
+from panoptic_dataset_collector.utils.jobs import JOB_DONE, JobQueue, ModelHost
+from panoptic_dataset_collector.utils.metrics import get_metrics
+from panoptic_dataset_collector.utils.panoptic_annotator import SAM_TYPES
+
+
+# Main function
+def main():
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description="Generate a single COCO panoptic database from a file of searches."
+    )
+    parser.add_argument(
+        "--queries_file",
+        help="Yaml file with a list of queries, each with a search key, a label file or "
+        "labels and an optional number of search pages",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--name",
+        help="Name of the dataset folder, defaults to the name of the queries file",
+        default="",
+        type=str,
+    )
+    parser.add_argument(
+        "--search_pages",
+        help="Number of pages to search (1-10) for queries without their own",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--api_key",
+        help="Your Google API key",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--engine_id",
+        help="Your Google custom search engine id",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--parallel_queries",
+        help="Number of queries collected at the same time.",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--commercial_only",
+        help="Download images with only commercial license",
+        default=False,
+        type=bool,
+    )
+    parser.add_argument(
+        "--deep_search",
+        help="Use the returned page urls to search for more images",
+        default=False,
+        type=bool,
+    )
+    parser.add_argument(
+        "--sam_type",
+        help="Type of SAM to use [vit_h, vit_l, vit_b]. vit_h is GPU memory intensive but accurate.",
+        default="vit_l",
+        choices=SAM_TYPES,
+        type=str,
+    )
+    parser.add_argument(
+        "--box_threshold",
+        help="Threshold for bounding box.",
+        default=0.3,
+        type=float,
+    )
+    parser.add_argument(
+        "--text_threshold",
+        help="Threshold for text.",
+        default=0.25,
+        type=float,
+    )
+    parser.add_argument(
+        "--download_workers",
+        help="Size of the http connection pool shared by all queries.",
+        default=16,
+        type=int,
+    )
+    parser.add_argument(
+        "--download_timeout",
+        help="Timeout in seconds for each image request.",
+        default=10.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--max_retries",
+        help="Number of retries with exponential backoff for failed requests.",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--decode_workers",
+        help="Number of processes decoding, validating and resizing downloaded images.",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--dedup_distance",
+        help="Max hamming distance of perceptual hashes for near-duplicate images.",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_queries",
+        help="Max number of paid search api queries for all searches, cached pages are free.",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--memory_budget_mb",
+        help="Free unused model memory only once the process uses more MB, 0 never frees it.",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--progress_interval",
+        help="Seconds between progress reports of the running queries.",
+        default=30,
+        type=float,
+    )
+    args = parser.parse_args()
+
+    queries = read_queries(args.queries_file, args.search_pages)
+    name = args.name or os.path.splitext(os.path.basename(args.queries_file))[0]
+    batch_folder = os.path.join(os.getcwd(), "panoptic_dataset_collector", "datasets", name)
+    os.makedirs(batch_folder, exist_ok=True)
+
+    # Queries share one model, one connection pool, one dedup index and one search quota
+    # Model calls take turns, crawling and downloads of the queries overlap
+    job_queue = JobQueue(
+        args.parallel_queries,
+        ModelHost(args.memory_budget_mb),
+        args.decode_workers,
+        preload_sam_type=args.sam_type,
+        http_client=HttpClient(
+            timeout=args.download_timeout,
+            max_retries=args.max_retries,
+            pool_maxsize=args.download_workers,
+        ),
+        dedup_index=DedupIndex(
+            os.path.join(batch_folder, "dedup_index.jsonl"), args.dedup_distance
+        ),
+        search_quota=SearchQuota(args.max_queries),
+    )
+    try:
+        jobs = submit_queries(
+            job_queue,
+            queries,
+            args.api_key,
+            args.engine_id,
+            batch_folder,
+            sam_type=args.sam_type,
+            commercial_only=args.commercial_only,
+            deep_search=args.deep_search,
+            box_threshold=args.box_threshold,
+            text_threshold=args.text_threshold,
+        )
+        wait_for_jobs(jobs, args.progress_interval)
+    finally:
+        job_queue.close()
+
+    for job in jobs:
+        print(job.describe())
+    # Failed or cancelled queries keep the images they annotated
+    summary = merge_datasets(
+        [job.download_folder for job in jobs],
+        os.path.join(batch_folder, "panoptic_annotation.json"),
+    )
+    done = sum(job.state == JOB_DONE for job in jobs)
+    print(f"{done} of {len(jobs)} queries done, merged dataset: {summary}")
+    print(f"Search api: {dict(quota_used=job_queue.search_quota.used)}")
+    print(get_metrics().summary())
+
+
+if __name__ == "__main__":
+    main()
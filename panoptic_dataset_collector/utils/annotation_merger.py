@@ -0,0 +1,144 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+from typing import Iterator, List, Tuple
+
+PARALLEL_MIN_FILES = 256
+
+
+# Function to parse an intermediate json into serialized annotation and image fragments
+def _parse_intermediate_json(json_path: str) -> Tuple[str, str, str]:
+    with open(json_path, "r") as f:
+        json_info = json.load(f)
+    annotations = ",".join(json.dumps(annotation) for annotation in json_info["annotations"])
+    images = ",".join(json.dumps(image_info) for image_info in json_info["images"])
+    return annotations, images, json.dumps(json_info["categories"])
+
+
+class AnnotationMerger:
+    def __init__(self, intermediate_json_dir: str, final_json_filename: str, workers: int = 0):
+        # Checks
+        assert intermediate_json_dir is not None and intermediate_json_dir != ""
+        assert final_json_filename is not None and final_json_filename != ""
+
+        # Merged fragments and the index of merged files are kept next to the final json
+        self.intermediate_json_dir = intermediate_json_dir
+        self.final_json_filename = final_json_filename
+        self.parts_path = f"{final_json_filename}.parts"
+        self.annotations_part = os.path.join(self.parts_path, "annotations.part")
+        self.images_part = os.path.join(self.parts_path, "images.part")
+        self.workers = workers or os.cpu_count() or 1
+        os.makedirs(self.parts_path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.parts_path, "index.sqlite"))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, mtime REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._conn.commit()
+
+    def _get_meta(self, key: str, default: str) -> str:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value: str):
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    # Function to drop all merged fragments
+    def _reset(self):
+        self._conn.execute("DELETE FROM files")
+        self._conn.execute("DELETE FROM meta")
+        self._conn.commit()
+        for part in [self.annotations_part, self.images_part]:
+            open(part, "wb").close()
+
+    # Function to find new intermediate files, a changed or removed file triggers a rebuild
+    def _new_files(self) -> List[Tuple[str, float]]:
+        new_files = []
+        seen = 0
+        for entry in os.scandir(self.intermediate_json_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            mtime = entry.stat().st_mtime
+            row = self._conn.execute(
+                "SELECT mtime FROM files WHERE name = ?", (entry.name,)
+            ).fetchone()
+            if row is None:
+                new_files.append((entry.name, mtime))
+            elif row[0] != mtime:
+                self._reset()
+                return self._new_files()
+            else:
+                seen += 1
+        if seen != self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]:
+            self._reset()
+            return self._new_files()
+        return sorted(new_files)
+
+    def _parse(self, json_paths: List[str]) -> Iterator[Tuple[str, str, str]]:
+        if self.workers == 1 or len(json_paths) < PARALLEL_MIN_FILES:
+            yield from map(_parse_intermediate_json, json_paths)
+            return
+        # Merges run next to pipeline threads, forked processes could inherit their held locks
+        with multiprocessing.get_context("spawn").Pool(self.workers) as pool:
+            yield from pool.imap(_parse_intermediate_json, json_paths, chunksize=64)
+
+    # Function to append fragments of new files, parts are truncated to the last committed size
+    def _append(self, new_files: List[Tuple[str, float]]):
+        annotations_size = int(self._get_meta("annotations_size", "0"))
+        images_size = int(self._get_meta("images_size", "0"))
+        categories = self._get_meta("categories", "")
+        json_paths = [os.path.join(self.intermediate_json_dir, name) for name, _ in new_files]
+        with open(self.annotations_part, "ab") as annotations_f, open(
+            self.images_part, "ab"
+        ) as images_f:
+            for part, size in [(annotations_f, annotations_size), (images_f, images_size)]:
+                part.truncate(size)
+                part.seek(size)
+            for annotations, images, file_categories in self._parse(json_paths):
+                categories = categories or file_categories
+                for part, fragment in [(annotations_f, annotations), (images_f, images)]:
+                    if fragment:
+                        if part.tell() > 0:
+                            part.write(b",")
+                        part.write(fragment.encode())
+            annotations_f.flush()
+            images_f.flush()
+            self._set_meta("annotations_size", str(annotations_f.tell()))
+            self._set_meta("images_size", str(images_f.tell()))
+        self._set_meta("categories", categories)
+        self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)", new_files)
+        self._conn.commit()
+
+    # Function to stream the merged fragments into the final COCO json
+    def _write_final(self):
+        tmp_filename = f"{self.final_json_filename}.tmp"
+        with open(tmp_filename, "wb") as f:
+            # Parts are missing until the first annotated image, e.g. of a cancelled run
+            f.write(b'{"annotations": [')
+            if os.path.isfile(self.annotations_part):
+                with open(self.annotations_part, "rb") as part:
+                    shutil.copyfileobj(part, f)
+            f.write(b'], "images": [')
+            if os.path.isfile(self.images_part):
+                with open(self.images_part, "rb") as part:
+                    shutil.copyfileobj(part, f)
+            f.write(b'], "categories": ')
+            f.write(self._get_meta("categories", "[]").encode())
+            f.write(b"}")
+        os.replace(tmp_filename, self.final_json_filename)
+
+    # Function to merge new intermediate files into the final json, returns their number
+    def merge(self) -> int:
+        new_files = self._new_files()
+        if new_files:
+            self._append(new_files)
+        if new_files or not os.path.isfile(self.final_json_filename):
+            self._write_final()
+        return len(new_files)
+
+    def close(self):
+        self._conn.close()
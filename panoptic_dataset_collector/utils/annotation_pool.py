@@ -0,0 +1,144 @@
+import multiprocessing
+import multiprocessing.util
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Annotator of the current worker process
+_annotator = None
+
+
+def _init_worker(
+    download_folder: str,
+    label_file: str,
+    sam_type: str,
+    feature_cache_mb: float,
+    torch_threads: int,
+    mask_format: str,
+    memory_budget_mb: float,
+    prescreen_threshold: float,
+    prescreen_size: int,
+    output_format: str,
+    shard_size_mb: float,
+):
+    global _annotator
+    import torch
+
+    from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+
+    # Workers split the cores instead of all running one thread per core
+    torch.set_num_threads(torch_threads)
+    _annotator = PanopticAnnotator(
+        download_folder,
+        label_file,
+        sam_type,
+        feature_cache_mb,
+        mask_format=mask_format,
+        memory_budget_mb=memory_budget_mb,
+        prescreen_threshold=prescreen_threshold,
+        prescreen_size=prescreen_size,
+        output_format=output_format,
+        shard_size_mb=shard_size_mb,
+    )
+    # Workers exit without running atexit handlers, the outputs are finished when they exit
+    multiprocessing.util.Finalize(None, _annotator.close, exitpriority=0)
+
+
+# Function to annotate one image in a worker, returns the drawn image and the json path
+# The json path is empty if no instance was found
+def _annotate(
+    img_path: str,
+    box_threshold: float,
+    text_threshold: float,
+    image_array: Optional[np.ndarray],
+) -> Tuple[np.ndarray, str]:
+    image_labels = _annotator.predict_annotation(
+        img_path, box_threshold, text_threshold, image_array
+    )
+    labeled_image = _annotator.write_annotation(image_labels)
+    json_path = ""
+    if len(image_labels["masks"]):
+        json_path = _annotator.annotation_json_path(img_path)
+    return labeled_image, json_path
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _combine_all_annotations():
+    _annotator.combine_all_annotations()
+
+
+def _clear_feature_cache():
+    _annotator.clear_feature_cache()
+
+
+class AnnotationPool:
+    def __init__(
+        self,
+        download_folder: str,
+        label_file: str,
+        sam_type: str = "vit_l",
+        feature_cache_mb: float = 0,
+        num_workers: int = 2,
+        torch_threads: int = 0,
+        mask_format: str = "png",
+        memory_budget_mb: float = 0,
+        prescreen_threshold: float = 0,
+        prescreen_size: int = 400,
+        output_format: str = "files",
+        shard_size_mb: float = 1024,
+    ):
+        # Checks
+        assert num_workers > 0 and torch_threads >= 0
+
+        # Each worker process loads its own model
+        self.num_workers = num_workers
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                download_folder,
+                label_file,
+                sam_type,
+                feature_cache_mb,
+                self.torch_threads,
+                mask_format,
+                memory_budget_mb,
+                prescreen_threshold,
+                prescreen_size,
+                output_format,
+                shard_size_mb,
+            ),
+        )
+        # Start all workers now so the models load while the first pages are crawled
+        for _ in range(num_workers):
+            self._executor.submit(_ready)
+
+    # Function to annotate one image in the next free worker, writes its json and png outputs
+    def annotate(
+        self,
+        img_path: str,
+        box_threshold: float,
+        text_threshold: float,
+        image_array: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, str]:
+        return self._executor.submit(
+            _annotate, img_path, box_threshold, text_threshold, image_array
+        ).result()
+
+    # Function to combine the intermediate jsons written by all workers
+    def combine_all_annotations(self):
+        self._executor.submit(_combine_all_annotations).result()
+
+    def clear_feature_cache(self):
+        self._executor.submit(_clear_feature_cache).result()
+
+    # Function to stop the workers, each closes its outputs on exit
+    def close(self):
+        self._executor.shutdown(wait=True)
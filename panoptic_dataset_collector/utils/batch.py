@@ -0,0 +1,119 @@
+import os
+from typing import Dict, List
+
+from panoptic_dataset_collector.utils.io import read_json, read_yaml, write_json
+from panoptic_dataset_collector.utils.jobs import JOB_RUNNING, CollectionJob, JobQueue
+
+
+# Function to read a yaml file of queries, each with a search key and a label file or labels
+# Label files are relative to the queries file, missing page budgets use search_pages
+def read_queries(queries_file: str, search_pages: int = 10) -> List[Dict]:
+    info = read_yaml(queries_file)
+    entries = info["queries"] if isinstance(info, dict) else info
+    assert entries, f"No queries in {queries_file}"
+    queries = []
+    for entry in entries:
+        assert entry.get("search"), f"Query without a search key in {queries_file}"
+        assert entry.get("label_file") or entry.get(
+            "labels"
+        ), f"Query {entry['search']} has neither a label file nor labels"
+        label_file = entry.get("label_file")
+        if label_file is not None and not os.path.isabs(label_file):
+            label_file = os.path.join(
+                os.path.dirname(os.path.abspath(queries_file)), label_file
+            )
+        queries.append(
+            dict(
+                search=entry["search"],
+                label_file=label_file,
+                labels=entry.get("labels", []),
+                search_pages=int(entry.get("search_pages", search_pages)),
+            )
+        )
+    return queries
+
+
+# Function to queue a job per query, their datasets are folders of batch_folder
+def submit_queries(
+    job_queue: JobQueue,
+    queries: List[Dict],
+    api_key: str,
+    engine_id: str,
+    batch_folder: str,
+    **job_options,
+) -> List[CollectionJob]:
+    return [
+        job_queue.submit(
+            query["search"],
+            query["labels"],
+            api_key,
+            engine_id,
+            query["search_pages"],
+            label_file=query["label_file"],
+            dataset_root=batch_folder,
+            **job_options,
+        )
+        for query in queries
+    ]
+
+
+# Function to wait for jobs, printing the progress of running ones every interval seconds
+def wait_for_jobs(jobs: List[CollectionJob], interval: float = 30):
+    for job in jobs:
+        while not job.wait(interval):
+            print("\n".join(other.describe() for other in jobs if other.state == JOB_RUNNING))
+
+
+# Function to merge the COCO jsons of several datasets into one with shared category ids
+# Categories with the same name share an id, ids index the merged categories as in the datasets
+# Image and panoptic png paths are relative to the folder of the merged json
+def merge_datasets(dataset_folders: List[str], final_json_filename: str) -> Dict[str, int]:
+    root = os.path.dirname(os.path.abspath(final_json_filename))
+    categories: List[Dict] = []
+    category_ids: Dict[str, int] = {}
+    annotations: List[Dict] = []
+    images: List[Dict] = []
+    for folder in dataset_folders:
+        json_path = os.path.join(folder, "panoptic_annotation.json")
+        if not os.path.isfile(json_path):
+            # Query without annotated images
+            continue
+        dataset = read_json(json_path)
+        prefix = os.path.relpath(os.path.abspath(folder), root)
+        id_map = []
+        for category in dataset["categories"]:
+            name = category["name"].lower().strip()
+            if name not in category_ids:
+                category_ids[name] = len(categories)
+                categories.append(dict(category, id=category_ids[name]))
+            id_map.append(category_ids[name])
+        # Image ids are file names, unique within a dataset only
+        for image_info in dataset["images"]:
+            images.append(
+                dict(
+                    image_info,
+                    id=f"{prefix}/{image_info['id']}",
+                    file_name=f"{prefix}/images/{image_info['file_name']}",
+                )
+            )
+        for annotation in dataset["annotations"]:
+            annotation = dict(
+                annotation,
+                image_id=f"{prefix}/{annotation['image_id']}",
+                segments_info=[
+                    dict(segment, category_id=id_map[segment["category_id"]])
+                    for segment in annotation["segments_info"]
+                ],
+            )
+            if "file_name" in annotation:
+                annotation["file_name"] = (
+                    f"{prefix}/panoptic_annotation/{annotation['file_name']}"
+                )
+            annotations.append(annotation)
+
+    tmp_filename = f"{final_json_filename}.tmp"
+    write_json(
+        tmp_filename, dict(annotations=annotations, images=images, categories=categories)
+    )
+    os.replace(tmp_filename, final_json_filename)
+    return dict(datasets=len(dataset_folders), images=len(images), categories=len(categories))
@@ -1,11 +1,49 @@
-import os
-from typing import List
-from urllib.parse import urljoin, urlparse
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
 
 import requests
-from bs4 import BeautifulSoup
 
-from panoptic_dataset_collector.utils.utils import safe_requests, valid_extension
+from panoptic_dataset_collector.utils.frontier import FrontierCrawler
+from panoptic_dataset_collector.utils.http_client import HttpClient, get_default_client
+from panoptic_dataset_collector.utils.metrics import get_metrics
+from panoptic_dataset_collector.utils.search_cache import SearchCache
+
+
+# Raised when a page could not be searched, the page is searched again by a later run
+class SearchError(Exception):
+    pass
+
+
+class SearchQuotaExceeded(SearchError):
+    pass
+
+
+class SearchQuota:
+    def __init__(self, max_queries: Optional[int] = None, queries_per_second: float = 5.0):
+        # Checks
+        assert queries_per_second > 0
+
+        # Paid search api budget and rate limit, shared by the crawlers of a batch of searches
+        self.max_queries = max_queries
+        self.queries_per_second = queries_per_second
+        self.used = 0
+        self._next_query = 0.0
+        self._lock = threading.Lock()
+
+    # Function to wait for the search api rate limit, returns False when the quota is used up
+    def acquire(self) -> bool:
+        with self._lock:
+            if self.max_queries is not None and self.used >= self.max_queries:
+                return False
+            self.used += 1
+            now = time.monotonic()
+            start = max(now, self._next_query)
+            self._next_query = start + 1.0 / self.queries_per_second
+        if start > now:
+            time.sleep(start - now)
+        return True
 
 
 class Crawler:
@@ -16,11 +54,20 @@ class Crawler:
         search_key: str,
         commercial_only: bool,
         deep_search: bool,
+        http_client: Optional[HttpClient] = None,
+        max_depth: int = 2,
+        max_pages: int = 50,
+        search_cache: Optional[SearchCache] = None,
+        max_queries: Optional[int] = None,
+        queries_per_second: float = 5.0,
+        prefetch_workers: int = 2,
+        quota: Optional[SearchQuota] = None,
     ):
         # Checks
         assert api_key is not None and api_key != ""
         assert engine_id is not None and engine_id != ""
         assert search_key is not None and search_key != ""
+        assert queries_per_second > 0 and prefetch_workers > 0
 
         # Fix license
         license = "(cc_publicdomain%7Ccc_attribute%7Ccc_sharealike%7Ccc_nonderived)"
@@ -39,77 +86,86 @@ class Crawler:
             "rights": license,
         }
         self.deep_search = deep_search
-
-    # Function to save the image urls
-    def _download_image_from_url(self, image_url: str) -> str:
-        image_path = ""
-        if not safe_requests(image_url):
-            return image_path
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            image_data = response.content
-            image_filename = image_url.split("/")[-1].split("?")[0]
-            if valid_extension(image_filename):
-                image_path = os.path.join(self.images_path, image_filename)
-                with open(image_path, "wb") as f:
-                    f.write(image_data)
-        return image_path
-
-    # Function to extract image URLs from a page
-    def _extract_image_urls(self, page_url: str) -> List[str]:
-        img_urls = []
-        if not safe_requests(page_url):
-            return img_urls
-        response = requests.get(page_url)
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        for img_tag in soup.find_all("img"):
-            img_url = img_tag.get("src")
-            if img_url and not img_url.startswith("data:"):
-                img_urls.append(urljoin(page_url, img_url))
-
-        return img_urls
-
-    def _deep_crawl(self, base_url: str) -> List[str]:
-        # image license
-
-        image_urls = []
-        crawled_urls = set()
-        to_crawl = [base_url]
-
-        while to_crawl:
-            current_url = to_crawl.pop()
-            if current_url in crawled_urls:
-                continue
-
-            crawled_urls.add(current_url)
-            image_urls += self._extract_image_urls(current_url)
-
-            # Extract links to other pages and add them to the crawling queue
-            if not safe_requests(current_url):
-                continue
-            response = requests.get(current_url)
-            soup = BeautifulSoup(response.content, "html.parser")
-            for link in soup.find_all("a", href=True):
-                link_url = urljoin(current_url, link["href"])
-                if urlparse(link_url).netloc == urlparse(base_url).netloc:
-                    to_crawl.append(link_url)
-
-        return image_urls
-
-    def crawl(self, start_id: int) -> List[str]:
+        self.http_client = http_client or get_default_client()
+        self.frontier = FrontierCrawler(self.http_client, max_depth, max_pages)
+        self.metrics = get_metrics()
+
+        # Search api budget, cache and prefetched pages
+        self.search_cache = search_cache
+        self.quota = quota or SearchQuota(max_queries, queries_per_second)
+        self.quota_used = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+        self._prefetched: Dict[int, Future] = {}
+
+    # Function to wait for the search api rate limit, returns False when the quota is used up
+    def _acquire_query(self) -> bool:
+        if not self.quota.acquire():
+            return False
+        with self._lock:
+            self.quota_used += 1
+        return True
+
+    # Function to get the search api response of a page, from the cache when possible
+    # Raises SearchError when the search fails, or SearchQuotaExceeded when the quota is used up
+    def search(self, start_id: int) -> Dict:
         params = self.params.copy()
         params["start"] = start_id
-        response = requests.get(self.url, params=params)
-        data = response.json()
+        if self.search_cache is not None:
+            data = self.search_cache.get(params)
+            if data is not None:
+                self.metrics.count("search_cache_hits")
+                return data
+        if not self._acquire_query():
+            raise SearchQuotaExceeded(f"Search quota of {self.quota.max_queries} queries used")
+        with self.metrics.timer("search_api"):
+            try:
+                response = self.http_client.get(self.url, params=params)
+                if response.status_code != 200:
+                    raise SearchError(f"Search api returned status {response.status_code}")
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                raise SearchError(f"Search api request failed: {e}") from e
+        if self.search_cache is not None:
+            self.search_cache.put(params, data)
+        return data
+
+    # Function to fetch search pages concurrently ahead of crawling them
+    def prefetch(self, start_ids: List[int]):
+        with self._lock:
+            for start_id in start_ids:
+                if start_id not in self._prefetched:
+                    self._prefetched[start_id] = self._executor.submit(self.search, start_id)
+
+    # Function to stop the prefetch threads, prefetched pages not yet searched are dropped
+    def close(self):
+        with self._lock:
+            for future in self._prefetched.values():
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def search_stats(self) -> Dict[str, int]:
+        stats = dict(quota_used=self.quota_used)
+        if self.search_cache is not None:
+            stats.update(
+                cache_hits=self.search_cache.hits, cache_misses=self.search_cache.misses
+            )
+        return stats
+
+    # Function to stream the image urls of a search page, deep search results follow the hits
+    def iter_crawl(self, start_id: int) -> Iterator[str]:
+        with self._lock:
+            prefetched = self._prefetched.pop(start_id, None)
+        data = prefetched.result() if prefetched is not None else self.search(start_id)
         items = data.get("items", [])
-        image_urls = []
 
         # Loop over all hits
-        for id in range(0, len(items)):
-            item = items[id]
-            image_urls += [item.get("link", "")]
-            page_url = item.get("image", {}).get("contextLink", "")
-            if self.deep_search:
-                image_urls += self._deep_crawl(page_url)
-        return image_urls
+        page_urls = []
+        for item in items:
+            yield item.get("link", "")
+            page_urls.append(item.get("image", {}).get("contextLink", ""))
+        if self.deep_search:
+            yield from self.frontier.crawl(page_urls)
+
+    def crawl(self, start_id: int) -> List[str]:
+        return list(self.iter_crawl(start_id))
@@ -0,0 +1,77 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from panoptic_dataset_collector.utils.io import save_image
+from panoptic_dataset_collector.utils.utils import get_resized_size
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+
+# Function run in the decode processes, returns the shared memory name and shape of the RGB image
+def _decode_image(
+    img_path: str, min_size: List[int], max_size: List[int]
+) -> Optional[Tuple[str, Tuple[int, ...]]]:
+    try:
+        # Only the header is read until the pixels are needed
+        with Image.open(img_path) as image:
+            width, height = image.size
+            if width > max_size[0] or height > max_size[1]:
+                new_size = get_resized_size(width, height, max_size)
+                # JPEG decoding scales down by a power of two that stays above the new size
+                image.draft("RGB", new_size)
+                image = image.resize(new_size, Image.BILINEAR)
+                save_image(img_path, image)
+            elif width <= min_size[0] or height <= min_size[1]:
+                return None
+            image_array = np.asarray(image.convert("RGB"))
+    except Exception:
+        return None
+
+    shm = SharedMemory(create=True, size=image_array.nbytes)
+    np.ndarray(image_array.shape, dtype=np.uint8, buffer=shm.buf)[:] = image_array
+    shm.close()
+    return shm.name, image_array.shape
+
+
+# Function to copy an image out of a shared memory segment and free the segment
+def _take_shared_image(shm_name: str, shape: Tuple[int, ...]) -> np.ndarray:
+    shm = SharedMemory(name=shm_name)
+    try:
+        image_array = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return image_array
+
+
+class ImageDecoder:
+    def __init__(self, workers: int = 2):
+        assert workers > 0
+        # Decode processes register their segments with the tracker of this process
+        if resource_tracker is not None:
+            resource_tracker.ensure_running()
+        # Spawned processes do not inherit the locks held by the pipeline threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    # Function to validate, resize and decode an image file in a decode process
+    # Pixels come back through shared memory instead of being pickled
+    def decode(
+        self, img_path: str, min_size: List[int], max_size: List[int]
+    ) -> Optional[np.ndarray]:
+        result = self._executor.submit(_decode_image, img_path, min_size, max_size).result()
+        if result is None:
+            return None
+        return _take_shared_image(*result)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from panoptic_dataset_collector.utils.io import hash_file, read_image
+
+
+# Function to compute the 64 bit difference hash of an image
+def dhash(image: Image, hash_size: int = 8) -> int:
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count("1")
+
+
+class BKTree:
+    def __init__(self):
+        # Node is [hash, key, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, hash: int, key: str):
+        self.size += 1
+        if self.root is None:
+            self.root = [hash, key, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(hash, node[0])
+            if distance not in node[2]:
+                node[2][distance] = [hash, key, {}]
+                return
+            node = node[2][distance]
+
+    # Function to find all keys within max_distance of hash, closest first
+    def search(self, hash: int, max_distance: int) -> List[Tuple[int, str]]:
+        if self.root is None:
+            return []
+        matches = []
+        to_search = [self.root]
+        while to_search:
+            node = to_search.pop()
+            distance = hamming_distance(hash, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            # Triangle inequality bounds the children worth visiting
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    to_search.append(child)
+        return sorted(matches)
+
+
+class DedupIndex:
+    def __init__(self, index_file: str, max_distance: int = 4):
+        # Checks
+        assert index_file is not None and index_file != ""
+        assert max_distance >= 0
+
+        self.index_file = index_file
+        self.max_distance = max_distance
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._content_hashes: Dict[str, str] = {}
+        self._tree = BKTree()
+
+        # Append-only index shared by all runs writing to the dataset
+        if os.path.isfile(index_file):
+            with open(index_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._add(entry["sha1"], entry["dhash"], entry["path"])
+
+    def _add(self, content_hash: str, perceptual_hash: int, image_path: str):
+        self._content_hashes[content_hash] = image_path
+        self._tree.add(perceptual_hash, image_path)
+
+    # Function to get the indexed image an image duplicates, unique images are added
+    def check_and_add(
+        self, image_path: str, image: Optional[Image.Image] = None
+    ) -> Optional[str]:
+        content_hash = hash_file(image_path)
+        if image is not None:
+            perceptual_hash = dhash(image)
+        else:
+            # An image read here is closed here, a passed image belongs to the caller
+            with read_image(image_path) as image:
+                perceptual_hash = dhash(image)
+        with self._lock:
+            duplicate = self._content_hashes.get(content_hash)
+            if duplicate is None:
+                matches = self._tree.search(perceptual_hash, self.max_distance)
+                duplicate = matches[0][1] if matches else None
+            if duplicate is not None:
+                if duplicate == image_path:
+                    return None
+                self.duplicates += 1
+                return duplicate
+
+            self._add(content_hash, perceptual_hash, image_path)
+            with open(self.index_file, "a") as f:
+                f.write(
+                    json.dumps(dict(sha1=content_hash, dhash=perceptual_hash, path=image_path))
+                    + "\n"
+                )
+        return None
+
+    def __len__(self) -> int:
+        return self._tree.size
@@ -0,0 +1,105 @@
+import os
+import shutil
+import threading
+import uuid
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from panoptic_dataset_collector.utils.io import read_json, write_json
+
+
+class FeatureCache:
+    def __init__(self, cache_dir: str, model_type: str, max_size_mb: float = 4096):
+        # Checks
+        assert cache_dir is not None and cache_dir != ""
+        assert max_size_mb > 0
+
+        # One directory per entry, the mtime of the entry marks its last use
+        self.cache_dir = os.path.join(cache_dir, model_type)
+        self.model_type = model_type
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    # Function to list cache entries as (mtime, path, size)
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, entry.path, size))
+        return entries
+
+    def _entry_path(self, image_hash: str, name: str) -> str:
+        return os.path.join(self.cache_dir, f"{image_hash}_{name}")
+
+    # Function to load memory-mapped arrays and metadata of a cached entry
+    # Arrays are copy on write, so they are writable without reading the whole file
+    def get(self, image_hash: str, name: str) -> Optional[Tuple[Dict[str, np.ndarray], Dict]]:
+        entry_path = self._entry_path(image_hash, name)
+        try:
+            info = read_json(os.path.join(entry_path, "meta.json"))
+            arrays = {
+                key: np.load(os.path.join(entry_path, f"{key}.npy"), mmap_mode="c")
+                for key in info["arrays"]
+            }
+            os.utime(entry_path)
+        except (RuntimeError, OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arrays, info["meta"]
+
+    def put(
+        self,
+        image_hash: str,
+        name: str,
+        arrays: Dict[str, np.ndarray],
+        meta: Optional[Dict] = None,
+    ):
+        entry_path = self._entry_path(image_hash, name)
+        # Write to a temporary directory and rename so readers never see partial entries
+        tmp_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}")
+        os.makedirs(tmp_path)
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{key}.npy"), np.ascontiguousarray(array))
+        write_json(
+            os.path.join(tmp_path, "meta.json"), dict(arrays=list(arrays), meta=meta or {})
+        )
+        size = sum(f.stat().st_size for f in os.scandir(tmp_path))
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Entry written meanwhile by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    # Function to remove least recently used entries until the cache is 10% below its size cap
+    # The margin lets the next puts add entries without listing the cache again
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, entry_path, size in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            self._size -= size
+
+    # Function to drop cached entries of one image or the whole cache
+    def invalidate(self, image_hash: Optional[str] = None):
+        with self._lock:
+            for _, entry_path, size in self._entries():
+                if image_hash is None or os.path.basename(entry_path).startswith(image_hash):
+                    shutil.rmtree(entry_path, ignore_errors=True)
+                    self._size -= size
@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Tuple
+from urllib.parse import urlparse
+
+
+class ConcurrentFetcher:
+    def __init__(
+        self,
+        max_workers: int = 16,
+        max_per_host: int = 4,
+        max_in_flight: int = 32,
+        timeout: float = 10.0,
+    ):
+        # Checks
+        assert max_workers > 0
+        assert max_per_host > 0
+        assert max_in_flight >= max_workers
+
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+
+        # Bounded pool shared by every fetch of this instance
+        # Urls of a host at its limit wait in the queue of the host instead of holding a
+        # pool thread, so the other hosts keep the pool busy
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._host_active: Dict[str, int] = {}
+        self._host_pending: Dict[str, Deque[Tuple[Callable[[str], Any], str, Future]]] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _run(self, host: str, fn: Callable[[str], Any], url: str, future: Future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(url))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            self._release(host)
+
+    # Function to pass the slot of a finished url to the next pending url of its host
+    def _release(self, host: str):
+        with self._lock:
+            pending = self._host_pending.get(host)
+            if pending and not self._closed:
+                fn, url, future = pending.popleft()
+                self._executor.submit(self._run, host, fn, url, future)
+                return
+            self._host_active[host] -= 1
+            if self._host_active[host] == 0 and not pending:
+                del self._host_active[host]
+                self._host_pending.pop(host, None)
+
+    # Function to submit a single url, blocks while the in-flight cap is reached
+    def submit(self, fn: Callable[[str], Any], url: str) -> Future:
+        self._in_flight.acquire()
+        future = Future()
+        host = urlparse(url).netloc
+        with self._lock:
+            if self._closed:
+                self._in_flight.release()
+                raise RuntimeError("Cannot fetch urls after the fetcher is closed")
+            if self._host_active.get(host, 0) < self.max_per_host:
+                self._host_active[host] = self._host_active.get(host, 0) + 1
+                self._executor.submit(self._run, host, fn, url, future)
+            else:
+                self._host_pending.setdefault(host, deque()).append((fn, url, future))
+        future.add_done_callback(lambda _: self._in_flight.release())
+        return future
+
+    # Function to apply fn to all urls concurrently, results keep the order of urls
+    def map(self, fn: Callable[[str], Any], urls: Iterable[str]) -> List[Any]:
+        futures = [self.submit(fn, url) for url in urls]
+        return [future.result() for future in futures]
+
+    # Function to stop the pool, urls still waiting for their host are cancelled
+    def close(self):
+        with self._lock:
+            self._closed = True
+            pending = [item for queue in self._host_pending.values() for item in queue]
+            self._host_pending.clear()
+        for _, _, future in pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
@@ -1,21 +1,49 @@
+import hashlib
+import itertools
 import os
-from typing import List
+import threading
+from typing import Iterator, List, Optional, Set, Tuple
 
+import numpy as np
 import requests
+from PIL import Image, ImageFile
 
-from panoptic_dataset_collector.utils.io import delete_file, read_image, save_image
+from panoptic_dataset_collector.utils.decoder import ImageDecoder
+from panoptic_dataset_collector.utils.dedup import DedupIndex
+from panoptic_dataset_collector.utils.fetcher import ConcurrentFetcher
+from panoptic_dataset_collector.utils.http_client import HttpClient
+from panoptic_dataset_collector.utils.io import (
+    delete_file,
+    read_image,
+    save_image,
+    write_stream,
+)
+from panoptic_dataset_collector.utils.metrics import get_metrics
 from panoptic_dataset_collector.utils.utils import (
+    fetch_url,
     resize_image_keep_aspect_ratio,
-    safe_requests,
     valid_extension,
 )
 
+# Image formats accepted by the header check and the extension they are saved with
+IMAGE_FORMATS = {"JPEG": ".jpg", "PNG": ".png"}
+# Content types of servers that do not label their images
+GENERIC_CONTENT_TYPES = ["", "application/octet-stream", "binary/octet-stream"]
+
 
 class Filter:
     def __init__(
         self,
         commercial_only: bool,
         download_folder: str,
+        max_workers: int = 16,
+        max_per_host: int = 4,
+        max_in_flight: int = 32,
+        timeout: float = 10.0,
+        http_client: Optional[HttpClient] = None,
+        dedup_index: Optional[DedupIndex] = None,
+        decoder: Optional[ImageDecoder] = None,
+        validate_headers: bool = True,
     ):
         # Checks
         assert download_folder is not None and download_folder != ""
@@ -27,40 +55,130 @@ class Filter:
 
         # Intermediate variables
         self.images_path = os.path.join(download_folder, "images")
-        os.makedirs(self.images_path, exist_ok=False)
+        os.makedirs(self.images_path, exist_ok=True)
         self.min_size = [300, 300]
         self.max_size = [1333, 1333]
 
-    # Function to save the image urls
-    def _download_image_from_url(self, image_url: str, previous_image_paths: List[str]) -> str:
-        image_path = ""
-        if not safe_requests(image_url):
-            return image_path
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            image_data = response.content
+        # Concurrent downloads
+        self.timeout = timeout
+        self.chunk_size = 64 * 1024
+        # Format and dimensions are read from the first bytes of the body, so unusable images
+        # are rejected before they are transferred and urls need no image extension
+        self.validate_headers = validate_headers
+        self.header_bytes = 256 * 1024
+        self.max_bytes = 20 * 1024 * 1024
+        self.fetcher = ConcurrentFetcher(max_workers, max_per_host, max_in_flight, timeout)
+        self._lock = threading.Lock()
+        self.reserved_paths: Set[str] = set()
+        self.dedup_index = dedup_index
+        self.decoder = decoder
+        self.metrics = get_metrics()
+        self.http_client = http_client or HttpClient(
+            timeout=timeout, pool_maxsize=max_per_host
+        )
+
+    # Function to read the start of a body until its image header is parsed
+    # Returns the bytes read and the image, None if no header was found within header_bytes
+    def _read_image_header(
+        self, chunks: Iterator[bytes]
+    ) -> Tuple[bytes, Optional[Image.Image]]:
+        parser = ImageFile.Parser()
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            try:
+                parser.feed(chunk)
+            except (OSError, SyntaxError, ValueError):
+                break
+            if parser.image is not None or size >= self.header_bytes:
+                break
+        return b"".join(head), parser.image
+
+    # Function to check the headers and the image header of an open response
+    # Returns the first bytes of the body and the file extension, or the reject reason
+    def _validate_response(
+        self, response: requests.Response, chunks: Iterator[bytes]
+    ) -> Tuple[bytes, str, str]:
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if not content_type.startswith("image/") and content_type not in GENERIC_CONTENT_TYPES:
+            return b"", "", "content_type"
+        content_length = int(response.headers.get("Content-Length", "0") or 0)
+        if content_length > self.max_bytes:
+            self.metrics.count("bytes_not_downloaded", content_length)
+            return b"", "", "too_large"
+        head, image = self._read_image_header(chunks)
+        if image is None or image.format not in IMAGE_FORMATS:
+            self.metrics.count("bytes_not_downloaded", max(0, content_length - len(head)))
+            return b"", "", "format"
+        width, height = image.size
+        if width <= self.min_size[0] or height <= self.min_size[1]:
+            self.metrics.count("bytes_not_downloaded", max(0, content_length - len(head)))
+            return b"", "", "size"
+        return head, IMAGE_FORMATS[image.format], ""
+
+    # Function to get the file name of an image url, with the extension of its sniffed format
+    def _image_filename(self, image_url: str, extension: str) -> str:
+        image_filename = image_url.split("/")[-1].split("?")[0]
+        stem, url_extension = os.path.splitext(image_filename)
+        if url_extension.lower().replace(".jpeg", ".jpg") == extension:
+            return image_filename
+        # Urls without an extension, or with one that does not match the content
+        stem = stem or hashlib.sha1(image_url.encode()).hexdigest()[:8]
+        return f"{stem}{extension}"
+
+    # Function to stream the image body of an open response to disk
+    # Returns the image path, or an empty path and the reject reason
+    def _download_image_from_url(
+        self, image_url: str, response: requests.Response
+    ) -> Tuple[str, str]:
+        chunks = response.iter_content(chunk_size=self.chunk_size)
+        if self.validate_headers:
+            head, extension, reason = self._validate_response(response, chunks)
+            if reason != "":
+                # Closing the response aborts the rest of the transfer
+                return "", reason
+            image_filename = self._image_filename(image_url, extension)
+            chunks = itertools.chain([head], chunks)
+        else:
             image_filename = image_url.split("/")[-1].split("?")[0]
-            if valid_extension(image_filename):
-                image_path = os.path.join(self.images_path, image_filename)
-                if image_path in previous_image_paths:
-                    return ""
-                with open(image_path, "wb") as f:
-                    f.write(image_data)
-        return image_path
+            if not valid_extension(image_filename):
+                return "", "extension"
+        image_path = os.path.join(self.images_path, image_filename)
+        with self._lock:
+            if image_path in self.reserved_paths:
+                # Different images often share names like image.jpg, make the name unique per url
+                stem, extension = os.path.splitext(image_filename)
+                url_hash = hashlib.sha1(image_url.encode()).hexdigest()[:8]
+                image_path = os.path.join(self.images_path, f"{stem}_{url_hash}{extension}")
+                if image_path in self.reserved_paths:
+                    return "", "name"
+            self.reserved_paths.add(image_path)
+        try:
+            write_stream(image_path, chunks)
+        except requests.RequestException:
+            # Connection dropped mid-body, remove the partial file
+            delete_file(image_path)
+            with self._lock:
+                self.reserved_paths.discard(image_path)
+            raise
+        return image_path, ""
 
     # Function to filter images based on license
-    def _filter_images_by_license(self, img_urls: List[str]) -> List[str]:
-        filtered_urls = []
-        for img_url in img_urls:
-            if not safe_requests(img_url):
-                continue
-            response = requests.head(img_url)
-            if response.headers.get("License", "").lower() in [self.license_keyword, ""]:
-                filtered_urls.append(img_url)
-        return filtered_urls
+    def _filter_image_by_license(self, response: requests.Response) -> bool:
+        return response.headers.get("License", "").lower() in [self.license_keyword, ""]
 
     # Function to filter images based on size
     def _filter_image_by_size(self, img_path: str) -> bool:
+        with self.metrics.timer("filter"):
+            if self._check_image_size(img_path):
+                return True
+        self.metrics.count("images_rejected", reason="size")
+        return False
+
+    # Function to check the image size, resizing oversized images in place
+    def _check_image_size(self, img_path: str) -> bool:
         try:
             image = read_image(img_path)
             width, height = image.size
@@ -77,13 +195,85 @@ class Filter:
         delete_file(img_path)
         return False
 
+    # Function to run license check and download of one url
+    def _download_image(self, img_url: str) -> str:
+        with self.metrics.timer("fetch"):
+            img_path, reason = self._fetch_image(img_url)
+        if img_path == "":
+            self.metrics.count("images_rejected", reason=reason)
+        else:
+            self.metrics.count("images_downloaded")
+        return img_path
+
+    # Function to download one url, returns the image path or the reason it was rejected
+    def _fetch_image(self, img_url: str) -> Tuple[str, str]:
+        # Single request shared by the reachability, license and download steps
+        response = fetch_url(img_url, self.timeout, self.http_client)
+        if response is None:
+            return "", "network"
+        try:
+            with response:
+                if response.status_code != 200:
+                    return "", "status"
+                if not self._filter_image_by_license(response):
+                    return "", "license"
+                return self._download_image_from_url(img_url, response)
+        except requests.RequestException:
+            return "", "network"
+
+    # Function to run license check, download and size check of one url
+    def _download_and_filter_image(self, img_url: str) -> str:
+        img_path = self._download_image(img_url)
+        if img_path == "" or not self.filter_image(img_path):
+            return ""
+        print(f"Downloaded image {img_url}")
+        return img_path
+
+    # Function to download one url within the host and in-flight limits
+    def download_image(self, img_url: str) -> str:
+        return self.fetcher.submit(self._download_image, img_url).result()
+
+    # Function to check a valid image against the dedup index, duplicates are deleted
+    def _filter_duplicate(self, img_path: str, image: Optional[Image.Image] = None) -> bool:
+        if self.dedup_index is None:
+            return True
+        with self.metrics.timer("dedup"):
+            duplicate = self.dedup_index.check_and_add(img_path, image)
+        if duplicate is None:
+            return True
+        self.metrics.count("images_rejected", reason="duplicate")
+        print(f"Skipping {img_path}, duplicate of {duplicate}")
+        delete_file(img_path)
+        return False
+
+    # Function to validate, resize and deduplicate a downloaded image, rejected files are deleted
+    def filter_image(self, img_path: str) -> bool:
+        if self._filter_image_by_size(img_path) and self._filter_duplicate(img_path):
+            return True
+        with self._lock:
+            self.reserved_paths.discard(img_path)
+        return False
+
+    # Function to validate, resize and deduplicate a downloaded image in the decode processes,
+    # returns the decoded RGB image or None if rejected
+    def decode_image(self, img_path: str) -> Optional[np.ndarray]:
+        assert self.decoder is not None
+        with self.metrics.timer("decode"):
+            image_array = self.decoder.decode(img_path, self.min_size, self.max_size)
+        if image_array is None:
+            self.metrics.count("images_rejected", reason="size")
+            delete_file(img_path)
+        elif self._filter_duplicate(img_path, Image.fromarray(image_array)):
+            return image_array
+        with self._lock:
+            self.reserved_paths.discard(img_path)
+        return None
+
     def filter_and_download_images(self, image_urls: List[str]) -> List[str]:
-        filtered_urls = self._filter_images_by_license(image_urls)
-        # Download valid images
-        image_paths = []
-        for img_url in filtered_urls:
-            img_path = self._download_image_from_url(img_url, image_paths)
-            if img_path != "" and self._filter_image_by_size(img_path):
-                image_paths += [img_path]
-                print(f"Downloaded image {img_url}")
-        return image_paths
+        # Download valid images concurrently
+        image_paths = self.fetcher.map(self._download_and_filter_image, image_urls)
+        return [img_path for img_path in image_paths if img_path != ""]
+
+    # Function to stop the download threads, the http client and decoder may be shared
+    def close(self):
+        self.fetcher.close()
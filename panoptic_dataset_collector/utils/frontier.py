@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+from bs4 import BeautifulSoup
+
+from panoptic_dataset_collector.utils.http_client import HttpClient, get_default_client
+from panoptic_dataset_collector.utils.metrics import get_metrics
+from panoptic_dataset_collector.utils.utils import fetch_url
+
+# lxml parses pages several times faster than html.parser when it is installed
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+
+class FrontierCrawler:
+    def __init__(
+        self,
+        http_client: Optional[HttpClient] = None,
+        max_depth: int = 2,
+        max_pages: int = 50,
+        workers: int = 8,
+        domain_delay: float = 0.5,
+        max_seconds: float = 120.0,
+        timeout: float = 5.0,
+        user_agent: str = "*",
+    ):
+        # Checks
+        assert max_depth >= 0 and max_pages > 0 and workers > 0
+
+        self.http_client = http_client or get_default_client()
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.workers = workers
+        self.domain_delay = domain_delay
+        self.max_seconds = max_seconds
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.metrics = get_metrics()
+
+        # Shared by all crawls so robots.txt is fetched once per domain
+        self._lock = threading.Lock()
+        self._robots: Dict[str, Optional[RobotFileParser]] = {}
+        self._next_request: Dict[str, float] = {}
+
+    # Function to get the cached robots.txt rules of a domain
+    def _robots_parser(self, url: str) -> Optional[RobotFileParser]:
+        parsed = urlparse(url)
+        domain = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            if domain in self._robots:
+                return self._robots[domain]
+        robots = None
+        response = fetch_url(f"{domain}/robots.txt", self.timeout, self.http_client)
+        if response is not None:
+            with response:
+                if response.status_code == 200:
+                    robots = RobotFileParser()
+                    try:
+                        robots.parse(response.text.splitlines())
+                    except requests.RequestException:
+                        robots = None
+        with self._lock:
+            self._robots[domain] = robots
+        return robots
+
+    def _allowed(self, url: str) -> bool:
+        robots = self._robots_parser(url)
+        return robots is None or robots.can_fetch(self.user_agent, url)
+
+    # Function to wait for the per-domain rate limit
+    def _wait_for_domain(self, url: str):
+        domain = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request.get(domain, now))
+            self._next_request[domain] = start + self.domain_delay
+        if start > now:
+            time.sleep(start - now)
+
+    # Function to fetch and parse a page once, returns its image urls and links
+    def _fetch_page(self, page_url: str) -> Tuple[List[str], List[str]]:
+        if not self._allowed(page_url):
+            return [], []
+        self._wait_for_domain(page_url)
+        with self.metrics.timer("crawl_page"):
+            response = fetch_url(page_url, self.timeout, self.http_client)
+            if response is None:
+                return [], []
+            with response:
+                # Skip non html links without downloading their body
+                content_type = response.headers.get("Content-Type", "")
+                if response.status_code != 200 or "html" not in content_type:
+                    return [], []
+                try:
+                    content = response.content
+                except requests.RequestException:
+                    return [], []
+        with self.metrics.timer("parse_page"):
+            soup = BeautifulSoup(content, HTML_PARSER)
+
+        img_urls = []
+        for img_tag in soup.find_all("img"):
+            img_url = img_tag.get("src")
+            if img_url and not img_url.startswith("data:"):
+                img_urls.append(urljoin(page_url, img_url))
+        links = [
+            urldefrag(urljoin(page_url, link["href"]))[0]
+            for link in soup.find_all("a", href=True)
+        ]
+        return img_urls, links
+
+    # Function to crawl the domains of the seed urls breadth first, image urls are yielded as found
+    def crawl(self, seed_urls: List[str]) -> Iterator[str]:
+        deadline = time.monotonic() + self.max_seconds
+        seen_pages = set()
+        seen_images = set()
+        pages: Dict[str, int] = {}
+        # Frontier entries are (url, depth, seed domain)
+        frontier = deque()
+        for seed_url in seed_urls:
+            if seed_url and seed_url not in seen_pages:
+                seen_pages.add(seed_url)
+                frontier.append((seed_url, 0, urlparse(seed_url).netloc))
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        in_flight = {}
+        try:
+            while frontier or in_flight:
+                while frontier and len(in_flight) < self.workers:
+                    url, depth, domain = frontier.popleft()
+                    if pages.get(domain, 0) >= self.max_pages:
+                        continue
+                    pages[domain] = pages.get(domain, 0) + 1
+                    in_flight[executor.submit(self._fetch_page, url)] = (depth, domain)
+                if not in_flight:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"Deep search stopped after {self.max_seconds}s")
+                    break
+                done, _ = wait(in_flight, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth, domain = in_flight.pop(future)
+                    img_urls, links = future.result()
+                    for img_url in img_urls:
+                        if img_url not in seen_images:
+                            seen_images.add(img_url)
+                            yield img_url
+                    if depth >= self.max_depth:
+                        continue
+                    for link in links:
+                        if urlparse(link).netloc == domain and link not in seen_pages:
+                            seen_pages.add(link)
+                            frontier.append((link, depth + 1, domain))
+        finally:
+            # Pages still being fetched are bounded by the number of workers
+            executor.shutdown(wait=False)
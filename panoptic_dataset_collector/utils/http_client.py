@@ -0,0 +1,192 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpTimings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "retries": 0, "connections": 0}
+        self.seconds = {"connect": 0.0, "ttfb": 0.0, "transfer": 0.0}
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counts[name] += value
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.seconds[name] += seconds
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            summary = dict(self.counts)
+            summary.update(
+                {f"{name}_s": round(value, 3) for name, value in self.seconds.items()}
+            )
+        return summary
+
+
+# Function to build connection pool classes that time new connections
+def _timed_pool_classes(timings: HttpTimings) -> Dict[str, type]:
+    def timed_connection(base: type) -> type:
+        class TimedConnection(base):
+            def connect(self):
+                start = time.perf_counter()
+                super().connect()
+                timings.add("connect", time.perf_counter() - start)
+                timings.count("connections")
+
+        return TimedConnection
+
+    return {
+        "http": type(
+            "TimedHTTPConnectionPool",
+            (HTTPConnectionPool,),
+            {"ConnectionCls": timed_connection(HTTPConnection)},
+        ),
+        "https": type(
+            "TimedHTTPSConnectionPool",
+            (HTTPSConnectionPool,),
+            {"ConnectionCls": timed_connection(HTTPSConnection)},
+        ),
+    }
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def __init__(self, timings: HttpTimings, **kwargs):
+        self.timings = timings
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _timed_pool_classes(self.timings)
+
+
+# Function to parse a Retry-After header given in seconds or as a http date
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    def __init__(
+        self,
+        timeout: float = 10.0,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 30.0,
+        pool_connections: int = 32,
+        pool_maxsize: int = 16,
+        retry_statuses: Tuple[int, ...] = RETRY_STATUSES,
+    ):
+        # Checks
+        assert max_retries >= 0
+        assert backoff_factor >= 0 and max_backoff >= 0
+
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.timings = HttpTimings()
+
+        # Keep-alive connections pooled per host, retries are handled below
+        adapter = TimedHTTPAdapter(
+            self.timings,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=0,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # Function to compute the exponential backoff with full jitter
+    def _backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2**attempt))
+
+    # Function to time the body transfer of a response when it is consumed
+    def _time_transfer(self, response: requests.Response):
+        iter_content = response.iter_content
+
+        def timed_iter_content(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                yield from iter_content(*args, **kwargs)
+            finally:
+                self.timings.add("transfer", time.perf_counter() - start)
+
+        response.iter_content = timed_iter_content
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        # Body is read lazily so that its transfer time is measured separately
+        stream = kwargs.pop("stream", False)
+        attempt = 0
+        while True:
+            self.timings.count("requests")
+            try:
+                response = self.session.request(method, url, stream=True, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                self.timings.add("ttfb", response.elapsed.total_seconds())
+                if (
+                    response.status_code not in self.retry_statuses
+                    or attempt >= self.max_retries
+                ):
+                    self._time_transfer(response)
+                    if not stream:
+                        response.content
+                    return response
+                # Rate limited or transient server error, honor Retry-After if given
+                delay = self._backoff(
+                    attempt, parse_retry_after(response.headers.get("Retry-After"))
+                )
+                response.close()
+            self.timings.count("retries")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_default_client: Optional[HttpClient] = None
+_default_client_lock = threading.Lock()
+
+
+# Function to get the client shared by callers that were not given one
+def get_default_client() -> HttpClient:
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
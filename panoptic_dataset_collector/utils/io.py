@@ -1,6 +1,8 @@
+import hashlib
+import io
 import json
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, List
 
 import numpy as np
 import yaml
@@ -52,5 +54,28 @@ def save_ndarray_image(image_path: str, image: np.ndarray) -> None:
     save_image(image_path, image_pil)
 
 
+def encode_png(image: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def write_stream(file_path: str, chunks: Iterable[bytes]) -> int:
+    size = 0
+    with open(file_path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
 def delete_file(file_path: str):
     os.remove(file_path)
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
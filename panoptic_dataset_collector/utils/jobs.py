@@ -0,0 +1,348 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from panoptic_dataset_collector.utils.crawler import Crawler, SearchQuota
+from panoptic_dataset_collector.utils.decoder import ImageDecoder
+from panoptic_dataset_collector.utils.dedup import DedupIndex
+from panoptic_dataset_collector.utils.feature_cache import FeatureCache
+from panoptic_dataset_collector.utils.filter import Filter
+from panoptic_dataset_collector.utils.http_client import HttpClient
+from panoptic_dataset_collector.utils.manifest import RunManifest
+from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+from panoptic_dataset_collector.utils.pipeline import Pipeline, build_collection_pipeline
+from panoptic_dataset_collector.utils.search_cache import SearchCache
+from panoptic_dataset_collector.utils.utils import make_label_file
+
+if TYPE_CHECKING:
+    from panoptic_dataset_collector.utils.model_runner import ModelRunner
+    from panoptic_dataset_collector.utils.runtime import ModelRuntime
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+RESULTS_PER_PAGE = 10
+
+
+class ModelHost:
+    def __init__(self, memory_budget_mb: float = 0):
+        # Models are loaded once per SAM type on a background thread and shared by all jobs
+        self.memory_budget_mb = memory_budget_mb
+        self._lock = threading.Lock()
+        self._models: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _load(self, sam_type: str) -> Tuple[object, "ModelRuntime"]:
+        import torch
+        from lang_sam import LangSAM
+
+        from panoptic_dataset_collector.utils.runtime import ModelRuntime
+
+        runtime = ModelRuntime(
+            self.memory_budget_mb, "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        return LangSAM(sam_type=sam_type), runtime
+
+    # Function to start loading the models of a SAM type without waiting for them
+    # A failed load is retried by the next call
+    def preload(self, sam_type: str) -> Future:
+        with self._lock:
+            future = self._models.get(sam_type)
+            if future is None or (future.done() and future.exception() is not None):
+                self._models[sam_type] = self._executor.submit(self._load, sam_type)
+            return self._models[sam_type]
+
+    # Function to get a runner on the shared models, waits until they are loaded
+    def runner(
+        self, sam_type: str, feature_cache: Optional[FeatureCache] = None
+    ) -> Tuple["ModelRuntime", "ModelRunner"]:
+        from panoptic_dataset_collector.utils.model_runner import ModelRunner
+
+        model, runtime = self.preload(sam_type).result()
+        return runtime, ModelRunner(model, feature_cache, runtime)
+
+
+class CollectionJob:
+    def __init__(
+        self,
+        job_id: int,
+        search_key: str,
+        class_labels: List[str],
+        api_key: str,
+        engine_id: str,
+        search_pages: int = 10,
+        sam_type: str = "vit_l",
+        commercial_only: bool = False,
+        deep_search: bool = False,
+        box_threshold: float = 0.3,
+        text_threshold: float = 0.25,
+        label_file: Optional[str] = None,
+        dataset_root: Optional[str] = None,
+    ):
+        # Checks
+        assert search_key is not None and search_key != ""
+        assert len(class_labels) > 0 or label_file is not None
+        assert search_pages > 0
+
+        self.id = job_id
+        self.search_key = search_key
+        self.class_labels = class_labels
+        self.api_key = api_key
+        self.engine_id = engine_id
+        self.search_pages = search_pages
+        self.sam_type = sam_type
+        self.commercial_only = commercial_only
+        self.deep_search = deep_search
+        self.box_threshold = box_threshold
+        self.text_threshold = text_threshold
+        # A label file takes the place of the class labels
+        self.label_file = label_file
+        dataset_root = dataset_root or os.path.join(
+            os.getcwd(), "panoptic_dataset_collector", "datasets"
+        )
+        self.download_folder = os.path.join(dataset_root, search_key.replace(" ", "_"))
+
+        # Progress, updated by the worker running the job
+        self.state = JOB_QUEUED
+        self.error = ""
+        self.images_done = 0
+        self.latest_image: Optional[np.ndarray] = None
+        self.start_time = 0.0
+        self.end_time = 0.0
+        self.pipeline: Optional[Pipeline] = None
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    # Function to wait for the end of the job, returns True if it has finished
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    # Function to cancel the job, a running job stops once its workers have stopped
+    def cancel(self):
+        self._cancel.set()
+        pipeline = self.pipeline
+        if pipeline is not None:
+            pipeline.stop()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    # Function to estimate the fraction of the job done from the image urls that left the
+    # pipeline, rejected by a stage or written by the last one
+    # Until all pages are crawled, pages are assumed to have as many urls as the crawled ones
+    def _fraction_done(self) -> float:
+        if self.state == JOB_DONE:
+            return 1.0
+        if self.pipeline is None:
+            return 0.0
+        stages = self.pipeline.stages
+        crawl = stages[0].stats
+        urls_per_page = RESULTS_PER_PAGE
+        if crawl.items_in:
+            urls_per_page = crawl.items_out / crawl.items_in
+        expected_urls = max(1.0, urls_per_page * self.search_pages)
+        # Stages after the crawl pass on at most one item per url
+        done_urls = stages[-1].stats.items_in
+        for stage in stages[1:-1]:
+            done_urls += stage.stats.items_in - stage.stats.items_out
+        return min(1.0, done_urls / expected_urls)
+
+    def progress(self) -> Dict:
+        end_time = self.end_time if self.finished else time.time()
+        elapsed = end_time - self.start_time if self.start_time else 0.0
+        fraction = self._fraction_done()
+        eta = None
+        if self.state == JOB_RUNNING and fraction > 0:
+            eta = elapsed * (1 - fraction) / fraction
+        return dict(
+            id=self.id,
+            state=self.state,
+            images_done=self.images_done,
+            fraction_done=round(fraction, 3),
+            images_per_sec=self.images_done / elapsed if elapsed else 0.0,
+            elapsed_s=round(elapsed, 1),
+            eta_s=round(eta, 1) if eta is not None else None,
+            error=self.error,
+        )
+
+    def describe(self) -> str:
+        progress = self.progress()
+        text = (
+            f"Job {self.id} {progress['state']}: {progress['images_done']} images, "
+            f"{progress['fraction_done'] * 100:.0f}% done, "
+            f"{progress['images_per_sec']:.2f} images/s"
+        )
+        if progress["eta_s"] is not None:
+            text += f", ETA {progress['eta_s']:.0f}s"
+        if progress["error"]:
+            text += f"\n{progress['error']}"
+        return text
+
+
+class JobQueue:
+    def __init__(
+        self,
+        workers: int = 2,
+        model_host: Optional[ModelHost] = None,
+        decode_workers: int = 2,
+        preload_sam_type: Optional[str] = "vit_l",
+        http_client: Optional[HttpClient] = None,
+        dedup_index: Optional[DedupIndex] = None,
+        search_quota: Optional[SearchQuota] = None,
+        max_finished_jobs: int = 20,
+    ):
+        # Checks
+        assert workers > 0 and max_finished_jobs >= 0
+
+        # Jobs share the models, the image decoder and the http connection pool
+        # Model calls of concurrent jobs take turns, their crawling and downloads overlap
+        self.model_host = model_host or ModelHost()
+        if preload_sam_type is not None:
+            self.model_host.preload(preload_sam_type)
+        self.decoder = ImageDecoder(decode_workers)
+        self.http_client = http_client or HttpClient()
+        # Without a shared dedup index and search quota every job has its own
+        self.dedup_index = dedup_index
+        self.search_quota = search_quota
+        # Only the latest finished jobs are kept, callers following a job hold on to it
+        self.jobs: Dict[int, CollectionJob] = {}
+        self.max_finished_jobs = max_finished_jobs
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Jobs of the same dataset folder run one after the other
+        self._folder_locks: Dict[str, threading.Lock] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    # Function to queue a collection job, returns it to follow its progress
+    def submit(self, *args, **kwargs) -> CollectionJob:
+        with self._lock:
+            job = CollectionJob(next(self._ids), *args, **kwargs)
+            self.jobs[job.id] = job
+            folder_lock = self._folder_locks.setdefault(job.download_folder, threading.Lock())
+        self._executor.submit(self._run, job, folder_lock)
+        return job
+
+    def get(self, job_id: int) -> Optional[CollectionJob]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: int):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    # Function to drop the oldest finished jobs and the folder locks no queued job uses
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+            for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+                del self.jobs[job_id]
+            folders = {job.download_folder for job in self.jobs.values() if not job.finished}
+            for folder in list(self._folder_locks):
+                if folder not in folders:
+                    del self._folder_locks[folder]
+
+    def _run(self, job: CollectionJob, folder_lock: threading.Lock):
+        try:
+            with folder_lock:
+                if not job.cancelled:
+                    self._collect(job)
+            job.state = JOB_CANCELLED if job.cancelled else JOB_DONE
+        except Exception as e:
+            job.state = JOB_FAILED
+            job.error = str(e)
+            print(f"Job {job.id} failed: {e}")
+        finally:
+            job.end_time = time.time()
+            job._finished.set()
+            self._prune()
+
+    def _collect(self, job: CollectionJob):
+        job.state = JOB_RUNNING
+        job.start_time = time.time()
+        label_file = job.label_file or make_label_file(job.class_labels, job.search_key)
+        # Threads and files of the job are closed when it ends, the shared ones stay open
+        with ExitStack() as resources:
+            manifest = RunManifest(job.download_folder)
+            resources.callback(manifest.close)
+            crawler = Crawler(
+                job.api_key,
+                job.engine_id,
+                job.search_key,
+                job.commercial_only,
+                job.deep_search,
+                http_client=self.http_client,
+                search_cache=SearchCache(
+                    os.path.join(os.path.dirname(job.download_folder), ".search_cache")
+                ),
+                quota=self.search_quota,
+            )
+            resources.callback(crawler.close)
+            dedup_index = self.dedup_index
+            if dedup_index is None:
+                dedup_index = DedupIndex(
+                    os.path.join(job.download_folder, "dedup_index.jsonl")
+                )
+            filter = Filter(
+                job.commercial_only,
+                job.download_folder,
+                http_client=self.http_client,
+                dedup_index=dedup_index,
+                decoder=self.decoder,
+            )
+            resources.callback(filter.close)
+            annotator = PanopticAnnotator(
+                job.download_folder,
+                label_file,
+                job.sam_type,
+                background_load=True,
+                model_host=self.model_host,
+            )
+            resources.callback(annotator.close)
+            start_ids = list(
+                range(1, job.search_pages * RESULTS_PER_PAGE + 1, RESULTS_PER_PAGE)
+            )
+            crawler.prefetch(
+                [start_id for start_id in start_ids if manifest.page(start_id) is None]
+            )
+            job.pipeline = build_collection_pipeline(
+                crawler,
+                filter,
+                annotator,
+                job.box_threshold,
+                job.text_threshold,
+                manifest=manifest,
+            )
+            # A cancel before the pipeline was assigned did not stop it
+            if job.cancelled:
+                job.pipeline.stop()
+            for labeled_image in job.pipeline.run(start_ids):
+                job.latest_image = labeled_image
+                job.images_done += 1
+                if job.cancelled:
+                    break
+            # Failed annotations are skipped by the pipeline, a failed model load fails the job
+            # A cancelled job does not wait for models that may still be loading
+            if not job.cancelled:
+                annotator.wait_for_model()
+            annotator.combine_all_annotations()
+            print(f"Job {job.id}\n{job.pipeline.summary()}")
+
+    def close(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self._executor.shutdown(wait=True)
+        self.decoder.close()
+        self.http_client.close()
@@ -0,0 +1,88 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+URL_DOWNLOADED = "downloaded"
+URL_REJECTED = "rejected"
+IMAGE_ANNOTATED = "annotated"
+IMAGE_EMPTY = "empty"
+
+
+class RunManifest:
+    def __init__(self, download_folder: str):
+        # Checks
+        assert download_folder is not None and download_folder != ""
+
+        os.makedirs(download_folder, exist_ok=True)
+        self.manifest_file = os.path.join(download_folder, "manifest.sqlite")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.manifest_file, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages (start_id INTEGER PRIMARY KEY, image_urls TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, status TEXT, image_path TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images "
+            "(image_path TEXT PRIMARY KEY, status TEXT, json_path TEXT)"
+        )
+
+    def _execute(self, query: str, params: Tuple = ()) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    # Function to get the image urls of an already searched page
+    def page(self, start_id: int) -> Optional[List[str]]:
+        rows = self._execute("SELECT image_urls FROM pages WHERE start_id = ?", (start_id,))
+        if not rows:
+            return None
+        return json.loads(rows[0][0])
+
+    def add_page(self, start_id: int, image_urls: List[str]):
+        self._execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?)", (start_id, json.dumps(image_urls))
+        )
+
+    def url(self, url: str) -> Optional[Tuple[str, str]]:
+        rows = self._execute("SELECT status, image_path FROM urls WHERE url = ?", (url,))
+        return rows[0] if rows else None
+
+    def set_url(self, url: str, status: str, image_path: str = ""):
+        self._execute(
+            "INSERT OR REPLACE INTO urls VALUES (?, ?, ?)", (url, status, image_path)
+        )
+
+    def image(self, image_path: str) -> Optional[Tuple[str, str]]:
+        rows = self._execute(
+            "SELECT status, json_path FROM images WHERE image_path = ?", (image_path,)
+        )
+        return rows[0] if rows else None
+
+    def set_image(self, image_path: str, status: str, json_path: str = ""):
+        self._execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?)", (image_path, status, json_path)
+        )
+
+    # Function to get the image paths downloaded by previous runs
+    def downloaded_paths(self) -> List[str]:
+        rows = self._execute("SELECT image_path FROM urls WHERE status = ?", (URL_DOWNLOADED,))
+        return [row[0] for row in rows]
+
+    def summary(self) -> Dict[str, int]:
+        summary = dict(pages=self._execute("SELECT COUNT(*) FROM pages")[0][0])
+        for table in ["urls", "images"]:
+            for status, count in self._execute(
+                f"SELECT status, COUNT(*) FROM {table} GROUP BY status"
+            ):
+                summary[f"{table}_{status}"] = count
+        return summary
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,195 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+PROMETHEUS_PREFIX = "dataset_collector"
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Metrics are keyed by name and sorted label pairs
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class TimerStats:
+    def __init__(self, window: int = 1024):
+        # Quantiles are computed over the most recent observations
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def quantiles(self) -> Dict[float, float]:
+        if not self.recent:
+            return {quantile: 0.0 for quantile in QUANTILES}
+        values = np.quantile(np.array(self.recent), QUANTILES)
+        return dict(zip(QUANTILES, values.tolist()))
+
+
+def _format_key(key: MetricKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[MetricKey, float] = {}
+        self.timers: Dict[MetricKey, TimerStats] = {}
+        self.start_time = time.time()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> MetricKey:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def count(self, name: str, value: float = 1, **labels: str):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.timers:
+                self.timers[key] = TimerStats()
+            self.timers[key].observe(seconds)
+
+    # Function to time the enclosed block, also when it raises
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            timers = {}
+            for key, stats in self.timers.items():
+                timers[_format_key(key)] = dict(
+                    count=stats.count,
+                    sum_s=round(stats.total, 6),
+                    max_s=round(stats.max, 6),
+                    **{
+                        f"p{int(quantile * 100)}_s": round(value, 6)
+                        for quantile, value in stats.quantiles().items()
+                    },
+                )
+            return dict(
+                uptime_s=round(time.time() - self.start_time, 3),
+                counters={_format_key(key): value for key, value in self.counters.items()},
+                timers=timers,
+            )
+
+    # Function to format the metrics in the Prometheus text exposition format
+    def prometheus_text(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in sorted(self.counters.items()):
+                    if key[0] == name:
+                        lines.append(f"{_format_key((metric, key[1]))} {value}")
+            for name in sorted({name for name, _ in self.timers}):
+                metric = f"{PROMETHEUS_PREFIX}_{name}_seconds"
+                lines.append(f"# TYPE {metric} summary")
+                for key, stats in sorted(self.timers.items()):
+                    if key[0] != name:
+                        continue
+                    for quantile, value in stats.quantiles().items():
+                        labels = key[1] + (("quantile", str(quantile)),)
+                        lines.append(f"{_format_key((metric, labels))} {value:.6f}")
+                    lines.append(f"{_format_key((metric + '_sum', key[1]))} {stats.total:.6f}")
+                    lines.append(f"{_format_key((metric + '_count', key[1]))} {stats.count}")
+        for name, value in sorted((gauges or {}).items()):
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Function to format an end of run table, slowest timers first
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        lines = [f"Metrics after {snapshot['uptime_s']:.1f}s"]
+        timers = sorted(snapshot["timers"].items(), key=lambda item: -item[1]["sum_s"])
+        for name, stats in timers:
+            lines.append(
+                f"  {name:<40} count={stats['count']:<6} total={stats['sum_s']:.2f}s "
+                f"p50={stats['p50_s'] * 1000:.1f}ms p99={stats['p99_s'] * 1000:.1f}ms "
+                f"max={stats['max_s'] * 1000:.1f}ms"
+            )
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"  {name:<40} {value:g}")
+        return "\n".join(lines)
+
+
+_default_metrics = Metrics()
+
+
+# Function to get the metrics registry shared by all components of a run
+def get_metrics() -> Metrics:
+    return _default_metrics
+
+
+class MetricsReporter:
+    def __init__(
+        self,
+        metrics: Metrics,
+        log_file: str,
+        prometheus_file: str,
+        interval: float = 30.0,
+        gauges: Optional[Callable[[], Dict[str, float]]] = None,
+    ):
+        # Checks
+        assert interval >= 0
+
+        # Appends a json snapshot to the log and rewrites the Prometheus text file
+        self.metrics = metrics
+        self.log_file = log_file
+        self.prometheus_file = prometheus_file
+        self.interval = interval
+        self.gauges = gauges
+        self._stop = threading.Event()
+        self._thread = None
+
+    def report(self):
+        gauges = self.gauges() if self.gauges is not None else {}
+        snapshot = self.metrics.snapshot()
+        snapshot.update(timestamp=time.time(), gauges=gauges)
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+        # Replace the file at once so scrapers never read a partial file
+        tmp_file = f"{self.prometheus_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self.metrics.prometheus_text(gauges))
+        os.replace(tmp_file, self.prometheus_file)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    # Function to stop periodic reports and write the final one
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
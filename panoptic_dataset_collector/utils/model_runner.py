@@ -0,0 +1,256 @@
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import groundingdino.datasets.transforms as T
+import numpy as np
+import torch
+from groundingdino.util import box_ops
+from groundingdino.util.inference import preprocess_caption
+from groundingdino.util.utils import get_phrases_from_posmap
+from lang_sam import LangSAM
+from lang_sam.lang_sam import transform_image
+from PIL import Image
+
+from panoptic_dataset_collector.utils.feature_cache import FeatureCache
+from panoptic_dataset_collector.utils.runtime import ModelRuntime
+
+# Shorter image side of GroundingDINO inputs in lang_sam
+GROUNDING_SIZE = 800
+
+
+# Function to transform an image like lang_sam with a different shorter side
+def transform_image_to_size(image_pil: Image.Image, size: int) -> torch.Tensor:
+    transform = T.Compose(
+        [
+            T.RandomResize([size], max_size=size * 1333 // GROUNDING_SIZE),
+            T.ToTensor(),
+            T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ]
+    )
+    image, _ = transform(image_pil, None)
+    return image
+
+
+class ModelRunner:
+    def __init__(
+        self,
+        model: LangSAM,
+        feature_cache: Optional[FeatureCache] = None,
+        runtime: Optional[ModelRuntime] = None,
+    ):
+        self.model = model
+        self.feature_cache = feature_cache
+        self.runtime = runtime or ModelRuntime(device=model.device)
+
+    def _use_cache(self, image_hash: Optional[str]) -> bool:
+        return self.feature_cache is not None and image_hash is not None
+
+    def _get_cached(self, image_hash: Optional[str], name: str) -> Optional[Tuple[Dict, Dict]]:
+        if not self._use_cache(image_hash):
+            return None
+        return self.feature_cache.get(image_hash, name)
+
+    # Function to stack same sized images into the reused input buffer of a model
+    # Buffers are inference tensors, so this only runs in inference mode
+    def _stack(self, name: str, images: List[torch.Tensor]) -> torch.Tensor:
+        shape = (len(images),) + tuple(images[0].shape)
+        batch = self.runtime.buffer(name, shape, images[0].dtype, images[0].device)
+        return torch.stack(images, out=batch)
+
+    # Function to get the raw GroundingDINO query logits and boxes of a batch of images
+    # Images are bucketed by their transformed size, so batches need no padding and every
+    # image gets the same outputs as when grounded alone
+    def _ground(
+        self,
+        images_pil: List[Image.Image],
+        caption: str,
+        image_hashes: List[Optional[str]],
+        size: int = GROUNDING_SIZE,
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        name = "dino_" + hashlib.sha1(caption.encode()).hexdigest()[:16]
+        if size != GROUNDING_SIZE:
+            name += f"_{size}"
+        results = [None] * len(images_pil)
+        buckets: Dict[Tuple[int, ...], List[Tuple[int, torch.Tensor]]] = {}
+        for id, (image_pil, image_hash) in enumerate(zip(images_pil, image_hashes)):
+            cached = self._get_cached(image_hash, name)
+            if cached is not None:
+                arrays, _ = cached
+                results[id] = (
+                    torch.from_numpy(arrays["logits"]),
+                    torch.from_numpy(arrays["boxes"]),
+                )
+                continue
+            if size == GROUNDING_SIZE:
+                image = transform_image(image_pil)
+            else:
+                image = transform_image_to_size(image_pil, size)
+            buckets.setdefault(tuple(image.shape), []).append((id, image))
+
+        model = self.model.groundingdino.to(self.model.device)
+        for bucket in buckets.values():
+            with torch.inference_mode():
+                images = self._stack("dino_input", [image for _, image in bucket])
+                outputs = model(images.to(self.model.device), captions=[caption] * len(bucket))
+            logits = outputs["pred_logits"].cpu().sigmoid()
+            boxes = outputs["pred_boxes"].cpu()
+            for row, (id, _) in enumerate(bucket):
+                results[id] = (logits[row], boxes[row])
+                if self._use_cache(image_hashes[id]):
+                    self.feature_cache.put(
+                        image_hashes[id],
+                        name,
+                        dict(logits=logits[row].numpy(), boxes=boxes[row].numpy()),
+                    )
+        return results
+
+    # Function to threshold grounding outputs, thresholds are applied after the cache
+    def _threshold(
+        self,
+        image_pil: Image.Image,
+        caption: str,
+        logits: torch.Tensor,
+        boxes: torch.Tensor,
+        box_threshold: float,
+        text_threshold: float,
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
+        mask = logits.max(dim=1)[0] > box_threshold
+        logits = logits[mask]
+        boxes = boxes[mask]
+
+        tokenizer = self.model.groundingdino.tokenizer
+        tokenized = tokenizer(caption)
+        phrases = [
+            get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer).replace(
+                ".", ""
+            )
+            for logit in logits
+        ]
+        width, height = image_pil.size
+        boxes = box_ops.box_cxcywh_to_xyxy(boxes) * torch.Tensor(
+            [width, height, width, height]
+        )
+        return boxes, logits.max(dim=1)[0], phrases
+
+    def predict_boxes(
+        self,
+        image_pil: Image.Image,
+        prompt: str,
+        box_threshold: float,
+        text_threshold: float,
+        image_hash: Optional[str] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
+        return self.predict_boxes_batch(
+            [image_pil], prompt, box_threshold, text_threshold, [image_hash]
+        )[0]
+
+    def predict_boxes_batch(
+        self,
+        images_pil: List[Image.Image],
+        prompt: str,
+        box_threshold: float,
+        text_threshold: float,
+        image_hashes: Optional[List[Optional[str]]] = None,
+    ) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+        caption = preprocess_caption(prompt)
+        image_hashes = image_hashes or [None] * len(images_pil)
+        grounded = self._ground(images_pil, caption, image_hashes)
+        return [
+            self._threshold(image_pil, caption, logits, boxes, box_threshold, text_threshold)
+            for image_pil, (logits, boxes) in zip(images_pil, grounded)
+        ]
+
+    # Function to get the best box score of every image in a low resolution grounding pass
+    def prescreen_scores(
+        self,
+        images_pil: List[Image.Image],
+        prompt: str,
+        size: int,
+        image_hashes: Optional[List[Optional[str]]] = None,
+    ) -> List[float]:
+        caption = preprocess_caption(prompt)
+        image_hashes = image_hashes or [None] * len(images_pil)
+        grounded = self._ground(images_pil, caption, image_hashes, size)
+        return [float(logits.max()) if logits.numel() else 0.0 for logits, _ in grounded]
+
+    # Function to compute or restore the SAM image embeddings of a batch of images
+    # SAM pads every image to the same square input, so the encoder runs once per batch
+    # Returns the predictor state of each image, to select with use_embedding
+    def embed_images(
+        self,
+        image_arrays: List[np.ndarray],
+        image_hashes: Optional[List[Optional[str]]] = None,
+    ) -> List[Dict]:
+        predictor = self.model.sam
+        image_hashes = image_hashes or [None] * len(image_arrays)
+        states = [None] * len(image_arrays)
+        inputs = []
+        for id, (image_array, image_hash) in enumerate(zip(image_arrays, image_hashes)):
+            cached = self._get_cached(image_hash, "sam")
+            if cached is not None:
+                arrays, meta = cached
+                states[id] = dict(
+                    features=torch.from_numpy(arrays["features"]),
+                    original_size=tuple(meta["original_size"]),
+                    input_size=tuple(meta["input_size"]),
+                )
+                continue
+            # Same preprocessing as SamPredictor.set_image
+            if predictor.model.image_format != "RGB":
+                image_array = image_array[..., ::-1]
+            input_image = predictor.transform.apply_image(image_array)
+            input_image = torch.as_tensor(input_image, device=predictor.device)
+            input_image = input_image.permute(2, 0, 1).contiguous()[None, :, :, :]
+            inputs.append(
+                (
+                    id,
+                    predictor.model.preprocess(input_image)[0],
+                    image_array.shape[:2],
+                    tuple(input_image.shape[-2:]),
+                )
+            )
+
+        if inputs:
+            with torch.inference_mode():
+                features = predictor.model.image_encoder(
+                    self._stack("sam_input", [input_image for _, input_image, _, _ in inputs])
+                )
+            for row, (id, _, original_size, input_size) in enumerate(inputs):
+                states[id] = dict(
+                    features=features[row : row + 1],
+                    original_size=original_size,
+                    input_size=input_size,
+                )
+                if self._use_cache(image_hashes[id]):
+                    self.feature_cache.put(
+                        image_hashes[id],
+                        "sam",
+                        dict(features=features[row : row + 1].cpu().numpy()),
+                        dict(original_size=original_size, input_size=input_size),
+                    )
+        return states
+
+    # Function to make an embedding of embed_images the current SAM image
+    def use_embedding(self, state: Dict):
+        predictor = self.model.sam
+        predictor.reset_image()
+        predictor.features = state["features"].to(predictor.device)
+        predictor.original_size = state["original_size"]
+        predictor.input_size = state["input_size"]
+        predictor.is_image_set = True
+
+    # Function to compute or restore the SAM image embedding
+    def set_image(self, image_array: np.ndarray, image_hash: Optional[str] = None):
+        self.use_embedding(self.embed_images([image_array], [image_hash])[0])
+
+    # Function to decode masks of all boxes from the current SAM image embedding
+    def predict_masks(self, image_array: np.ndarray, boxes: torch.Tensor) -> torch.Tensor:
+        predictor = self.model.sam
+        transformed_boxes = predictor.transform.apply_boxes_torch(boxes, image_array.shape[:2])
+        masks, _, _ = predictor.predict_torch(
+            point_coords=None,
+            point_labels=None,
+            boxes=transformed_boxes.to(predictor.device),
+            multimask_output=False,
+        )
+        return masks.cpu().squeeze(1)
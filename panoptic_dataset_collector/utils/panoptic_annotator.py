@@ -1,31 +1,79 @@
+import json
 import os
-from typing import List
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
 
 import numpy as np
-import torch
-from lang_sam import SAM_MODELS, LangSAM
-from lang_sam.utils import draw_image
+from PIL import Image
 
+from panoptic_dataset_collector.utils.feature_cache import FeatureCache
 from panoptic_dataset_collector.utils.io import (
     delete_file,
+    encode_png,
+    hash_file,
     read_image,
     read_yaml,
     save_ndarray_image,
     write_json,
 )
+from panoptic_dataset_collector.utils.metrics import get_metrics
+from panoptic_dataset_collector.utils.shards import (
+    PANOPTIC_SUFFIX,
+    ShardReader,
+    ShardWriter,
+)
 from panoptic_dataset_collector.utils.utils import (
     combine_annotations_in_dir,
-    free_mem,
-    get_intersection_ratio,
+    id2rgb,
+    map_phrases_to_labels,
+    mask_to_rle,
+    resolve_instance_overlaps,
 )
+from panoptic_dataset_collector.utils.writer import AsyncWriter
+
+# torch and lang_sam take seconds to import, they are only imported to load the models
+if TYPE_CHECKING:
+    import torch
+
+    from panoptic_dataset_collector.utils.jobs import ModelHost
+    from panoptic_dataset_collector.utils.model_runner import ModelRunner
+
+# Panoptic png with COCO RGB ids or RLE masks in the segments info
+MASK_FORMATS = ["png", "rle"]
+# A file per image and output, or tar shards packing the image and its outputs
+OUTPUT_FORMATS = ["files", "shards"]
+# Keys of lang_sam.SAM_MODELS
+SAM_TYPES = ["vit_h", "vit_l", "vit_b"]
 
 
 class PanopticAnnotator:
-    def __init__(self, download_folder: str, label_file: str, sam_type: str = "vit_l"):
+    def __init__(
+        self,
+        download_folder: str,
+        label_file: str,
+        sam_type: str = "vit_l",
+        feature_cache_mb: float = 0,
+        batch_size: int = 1,
+        mask_format: str = "png",
+        async_write: bool = False,
+        memory_budget_mb: float = 0,
+        background_load: bool = False,
+        model_host: Optional["ModelHost"] = None,
+        prescreen_threshold: float = 0,
+        prescreen_size: int = 400,
+        output_format: str = "files",
+        shard_size_mb: float = 1024,
+        visualize: bool = True,
+    ):
 
         # Checks
-        assert sam_type.lower() in list(SAM_MODELS.keys())
+        assert sam_type.lower() in SAM_TYPES
         assert label_file is not None and label_file != ""
+        assert batch_size > 0
+        assert mask_format in MASK_FORMATS
+        assert output_format in OUTPUT_FORMATS
+        assert 0 <= prescreen_threshold < 1 and prescreen_size > 0
 
         # Intermediate variables
         self.panoptic_annotation_path = os.path.join(download_folder, "panoptic_annotation")
@@ -33,69 +81,351 @@ class PanopticAnnotator:
         self.final_annotation_file_name = os.path.join(
             download_folder, "panoptic_annotation.json"
         )
+        self.shards_path = os.path.join(download_folder, "shards")
         self.image_cnt = 0
         self.valid_iou = 0.6
         self.valid_mask = 1000
+        self.batch_size = batch_size
+        # Images whose best box of a low resolution grounding pass scores below the
+        # threshold skip the full models, 0 runs the full models on every image
+        self.prescreen_threshold = prescreen_threshold
+        self.prescreen_size = prescreen_size
+        self.prescreen_stats = dict(
+            screened=0, skipped=0, prescreen_s=0.0, full_images=0, full_s=0.0
+        )
+        self.mask_format = mask_format
+        # Written images are returned with their labels drawn, otherwise as they are
+        self.visualize = visualize
+        # Outputs are written by a background thread while the next image is annotated
+        self.writer = AsyncWriter() if async_write else None
+        self.metrics = get_metrics()
 
         # Create result folders
-        os.makedirs(self.panoptic_annotation_path, exist_ok=False)
-        os.makedirs(self.intermediate_json_path, exist_ok=False)
+        # Shards keep large collections to a few large files, images are moved into them
+        self.shard_writer = None
+        if output_format == "shards":
+            self.shard_writer = ShardWriter(self.shards_path, shard_size_mb)
+        else:
+            os.makedirs(self.panoptic_annotation_path, exist_ok=True)
+            os.makedirs(self.intermediate_json_path, exist_ok=True)
 
         # Load model
         self.labels = []
         label_info = read_yaml(label_file)
         self.labels = label_info["categories"]
         assert len(self.labels) > 0
-        self.model = LangSAM(sam_type=sam_type.lower())
+        self.label_names = [lbl["name"] for lbl in self.labels]
+        # GroundingDINO separates the categories of a prompt with " . "
+        self.prompt = " . ".join(self.label_names)
+
+        # Cache image features next to the dataset so threshold sweeps only run decoders
+        self.feature_cache = None
+        if feature_cache_mb > 0:
+            self.feature_cache = FeatureCache(
+                os.path.join(os.path.dirname(download_folder), ".feature_cache"),
+                sam_type.lower(),
+                feature_cache_mb,
+            )
+
+        # With a background load the caller crawls and downloads while the models load
+        # With a model host the models are shared with the other annotators of the host
+        self.model_host = model_host
+        self.runtime = None
+        self.runner = None
+        self._load_error = None
+        self._model_loaded = threading.Event()
+        if background_load:
+            threading.Thread(
+                target=self._load_in_background,
+                args=(sam_type.lower(), memory_budget_mb),
+                daemon=True,
+            ).start()
+        else:
+            self._load(sam_type.lower(), memory_budget_mb)
+            self._model_loaded.set()
+
+    def _load(self, sam_type: str, memory_budget_mb: float):
+        import torch
+
+        from panoptic_dataset_collector.utils.runtime import ModelRuntime
+
+        with self.metrics.timer("model_load"):
+            if self.model_host is not None:
+                self.runtime, self.runner = self.model_host.runner(
+                    sam_type, self.feature_cache
+                )
+                return
+            # Memory is freed between batches only once the budget is exceeded
+            self.runtime = ModelRuntime(
+                memory_budget_mb, "cuda" if torch.cuda.is_available() else "cpu"
+            )
+            self.runner = self._load_model(sam_type)
+
+    def _load_in_background(self, sam_type: str, memory_budget_mb: float):
+        try:
+            self._load(sam_type, memory_budget_mb)
+        except Exception as e:
+            self._load_error = e
+        finally:
+            self._model_loaded.set()
 
-    def model(self) -> LangSAM:
-        return self.model
+    # Function to load the models, returns the runner used for inference
+    def _load_model(self, sam_type: str) -> "ModelRunner":
+        from lang_sam import LangSAM
 
-    # Function to generate panoptic results
+        from panoptic_dataset_collector.utils.model_runner import ModelRunner
+
+        self.model = LangSAM(sam_type=sam_type)
+        return ModelRunner(self.model, self.feature_cache, self.runtime)
+
+    # Function to wait for the models of a background load, raises if loading failed
+    def wait_for_model(self):
+        self._model_loaded.wait()
+        if self._load_error is not None:
+            raise RuntimeError("Loading the models failed") from self._load_error
+
+    # Function to generate panoptic results, an already decoded RGB image skips reading the file
     def _generate_image_labels(
-        self, img_path: str, box_threshold: float, text_threshold: float
-    ) -> np.ndarray:
-        image_pil = read_image(img_path, rgb=True)
-        image_array = np.asarray(image_pil)
-        masks = []
-        boxes = []
-        class_id = []
-        labels = []
-
-        # TODO: Avoid this loop
-        for id, lbl in enumerate(self.labels):
-            free_mem()
-            masks_lbl, boxes_lbl, phrases, logits = self.model.predict(
-                image_pil, lbl["name"], box_threshold, text_threshold
+        self,
+        img_path: str,
+        box_threshold: float,
+        text_threshold: float,
+        image_array: Optional[np.ndarray] = None,
+    ) -> Dict:
+        return self._generate_batch_labels(
+            [img_path], box_threshold, text_threshold, [image_array]
+        )[0]
+
+    # Function to generate panoptic results of a batch of images with one call per model
+    def _generate_batch_labels(
+        self,
+        img_paths: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        image_arrays: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> List[Dict]:
+        self.wait_for_model()
+        images_pil = []
+        image_arrays = list(image_arrays or [None] * len(img_paths))
+        for id, img_path in enumerate(img_paths):
+            if image_arrays[id] is None:
+                images_pil.append(read_image(img_path, rgb=True))
+                image_arrays[id] = np.asarray(images_pil[id])
+            else:
+                images_pil.append(Image.fromarray(image_arrays[id]))
+        image_hashes = [
+            hash_file(img_path) if self.feature_cache is not None else None
+            for img_path in img_paths
+        ]
+        # Skipped images get no labels and are deleted when written
+        batch_labels = [
+            dict(
+                img_path=img_path,
+                image_array=image_array,
+                masks=[],
+                boxes=[],
+                class_id=[],
+                labels=[],
+            )
+            for img_path, image_array in zip(img_paths, image_arrays)
+        ]
+        with self.runtime.session():
+            keep = list(range(len(img_paths)))
+            if self.prescreen_threshold > 0:
+                keep = self._prescreen(images_pil, image_hashes)
+            if keep:
+                start = time.perf_counter()
+                kept_labels = self._run_models(
+                    [img_paths[id] for id in keep],
+                    [images_pil[id] for id in keep],
+                    [image_arrays[id] for id in keep],
+                    [image_hashes[id] for id in keep],
+                    box_threshold,
+                    text_threshold,
+                )
+                self.prescreen_stats["full_images"] += len(keep)
+                self.prescreen_stats["full_s"] += time.perf_counter() - start
+                for id, image_labels in zip(keep, kept_labels):
+                    batch_labels[id] = image_labels
+        with self.metrics.timer("free_mem"):
+            if self.runtime.maybe_free():
+                self.metrics.count("memory_frees")
+        return batch_labels
+
+    # Function to get the ids of the images that pass the prescreen, runs in an inference session
+    def _prescreen(
+        self, images_pil: List[Image.Image], image_hashes: List[Optional[str]]
+    ) -> List[int]:
+        start = time.perf_counter()
+        with self.metrics.timer("prescreen"):
+            scores = self.runner.prescreen_scores(
+                images_pil, self.prompt, self.prescreen_size, image_hashes
             )
-            labels += [f"{phrase} {logit:.2f}" for phrase, logit in zip(phrases, logits)]
-            assert masks_lbl.shape[0] == boxes_lbl.shape[0]
-            if len(masks) == 0:
-                masks = masks_lbl
-                boxes = boxes_lbl
-            elif masks_lbl.shape[0]:
-                masks = torch.cat([masks, masks_lbl])
-                boxes = torch.cat([boxes, boxes_lbl])
-            class_id += [id] * len(masks_lbl)
+        keep = [id for id, score in enumerate(scores) if score >= self.prescreen_threshold]
+        self.prescreen_stats["screened"] += len(scores)
+        self.prescreen_stats["skipped"] += len(scores) - len(keep)
+        self.prescreen_stats["prescreen_s"] += time.perf_counter() - start
+        self.metrics.count("prescreen_passed", len(keep))
+        self.metrics.count("prescreen_skipped", len(scores) - len(keep))
+        return keep
+
+    # Function to summarize the skip rate and the model time saved by the prescreen
+    # The saving assumes skipped images would have cost as much as the screened in ones
+    def prescreen_summary(self) -> str:
+        stats = self.prescreen_stats
+        if stats["screened"] == 0:
+            return "Prescreen: no images screened"
+        full_per_image = stats["full_s"] / stats["full_images"] if stats["full_images"] else 0
+        saved = stats["skipped"] * full_per_image - stats["prescreen_s"]
+        return (
+            f"Prescreen: skipped {stats['skipped']} of {stats['screened']} images "
+            f"({100 * stats['skipped'] / stats['screened']:.0f}%), "
+            f"prescreen took {stats['prescreen_s']:.1f}s, saved about {saved:.1f}s of model time"
+        )
 
+    # Function to ground and segment a batch of images, runs in an inference session
+    def _run_models(
+        self,
+        img_paths: List[str],
+        images_pil: List[Image.Image],
+        image_arrays: List[np.ndarray],
+        image_hashes: List[Optional[str]],
+        box_threshold: float,
+        text_threshold: float,
+    ) -> List[Dict]:
+        # Ground all categories with a single prompt
+        with self.metrics.timer("grounding"):
+            grounded = self.runner.predict_boxes_batch(
+                images_pil, self.prompt, box_threshold, text_threshold, image_hashes
+            )
+        batch_labels = []
+        for img_path, image_array, (boxes, logits, phrases) in zip(
+            img_paths, image_arrays, grounded
+        ):
+            label_ids = map_phrases_to_labels(phrases, self.label_names)
+            # Keep the per category order, later instances take precedence on overlap
+            order = sorted(
+                [id for id, label_id in enumerate(label_ids) if label_id >= 0],
+                key=lambda id: label_ids[id],
+            )
+            for id in order:
+                self.metrics.count("instances", label=self.label_names[label_ids[id]])
+            batch_labels.append(
+                dict(
+                    img_path=img_path,
+                    image_array=image_array,
+                    masks=[],
+                    boxes=boxes[order],
+                    class_id=[label_ids[id] for id in order],
+                    labels=[f"{phrases[id]} {logits[id]:.2f}" for id in order],
+                )
+            )
+
+        # Compute the SAM image embeddings once and decode all boxes of an image from it
+        with_boxes = [
+            id for id, image_labels in enumerate(batch_labels) if len(image_labels["boxes"])
+        ]
+        with self.metrics.timer("segmentation"):
+            embeddings = self.runner.embed_images(
+                [image_arrays[id] for id in with_boxes],
+                [image_hashes[id] for id in with_boxes],
+            )
+        for id, embedding in zip(with_boxes, embeddings):
+            image_labels = batch_labels[id]
+            with self.metrics.timer("segmentation"):
+                self.runner.use_embedding(embedding)
+                masks = self.runner.predict_masks(
+                    image_labels["image_array"], image_labels["boxes"]
+                )
+            assert masks.shape[0] == image_labels["boxes"].shape[0]
+            image_labels["masks"] = masks
+        return batch_labels
+
+    # Function to write the panoptic results of an image and draw them
+    def _write_image_labels(
+        self, image_labels: Dict, on_written: Optional[Callable[[], None]] = None
+    ) -> np.ndarray:
+        img_path = image_labels["img_path"]
+        image_array = image_labels["image_array"]
+        masks = image_labels["masks"]
+        boxes = image_labels["boxes"]
+        labels = image_labels["labels"]
         if len(masks):
-            valid_ids = self._add_coco_segment(img_path, masks, boxes, class_id)
-            image_array = draw_image(
-                image_array,
-                masks[valid_ids, ...],
-                boxes[valid_ids, :],
-                [labels[id] for id in valid_ids],
+            valid_ids = self._add_coco_segment(
+                img_path, masks, boxes, image_labels["class_id"], on_written
             )
+            if self.visualize:
+                image_array = self._draw_labels(
+                    image_array,
+                    masks[valid_ids, ...],
+                    boxes[valid_ids, :],
+                    [labels[id] for id in valid_ids],
+                )
             return image_array
 
         # No valid labels in the downloaded image
         # Delete file
         delete_file(img_path)
+        if on_written is not None:
+            on_written()
         return image_array
 
+    # Function to draw the masks, boxes and labels of an image
+    def _draw_labels(
+        self,
+        image_array: np.ndarray,
+        masks: "torch.Tensor",
+        boxes: "torch.Tensor",
+        labels: List[str],
+    ) -> np.ndarray:
+        from lang_sam.utils import draw_image
+
+        return draw_image(image_array, masks, boxes, labels)
+
+    # Function to write the outputs of an image, on_written runs once they are on disk
+    def _save_outputs(
+        self,
+        panoptic_path: str,
+        panoptic_image: Optional[np.ndarray],
+        json_path: str,
+        json_info: Dict,
+        on_written: Optional[Callable[[], None]],
+    ):
+        with self.metrics.timer("write"):
+            if panoptic_image is not None:
+                save_ndarray_image(panoptic_path, id2rgb(panoptic_image))
+            write_json(json_path, json_info)
+        if on_written is not None:
+            on_written()
+
+    # Function to pack an image and its outputs into the current shard, the image file is removed
+    def _save_sample(
+        self,
+        img_path: str,
+        panoptic_image: Optional[np.ndarray],
+        json_info: Dict,
+        on_written: Optional[Callable[[], None]],
+    ):
+        with self.metrics.timer("write"):
+            img_id, extension = os.path.splitext(os.path.basename(img_path))
+            with open(img_path, "rb") as f:
+                files = {extension[1:]: f.read()}
+            if panoptic_image is not None:
+                files[PANOPTIC_SUFFIX] = encode_png(id2rgb(panoptic_image))
+            files["json"] = json.dumps(json_info).encode()
+            self.shard_writer.write(img_id, files)
+            delete_file(img_path)
+        if on_written is not None:
+            on_written()
+
     # Function to add panoptic annotation in coco format
     def _add_coco_segment(
-        self, img_path: str, masks: torch.Tensor, boxes: torch.Tensor, class_id: List[int]
+        self,
+        img_path: str,
+        masks: "torch.Tensor",
+        boxes: "torch.Tensor",
+        class_id: List[int],
+        on_written: Optional[Callable[[], None]] = None,
     ) -> List[int]:
         assert masks.shape[0] == boxes.shape[0] == len(class_id)
         self.image_cnt += 1
@@ -107,64 +437,136 @@ class PanopticAnnotator:
             file_name=panoptic_filename,
             segments_info=[],
         )
-        panoptic_image = np.zeros((masks.shape[1], masks.shape[2])).astype(np.uint8)
+        with self.metrics.timer("overlap_resolution"):
+            panoptic_image, valid_ids = resolve_instance_overlaps(
+                masks.numpy(), self.valid_mask, self.valid_iou
+            )
+        boxes = boxes.numpy()
         segment_info = dict()
-        valid_ids = dict()
-        for id in range(len(class_id)):
+        for id in valid_ids:
             new_instance_id = id + 1
-            new_instance_mask = masks[id].numpy()
-            if new_instance_mask.sum() > self.valid_mask:
-                iou, replace_instance = get_intersection_ratio(
-                    panoptic_image, new_instance_mask, new_instance_id
+            bbox = [int(coord) for coord in boxes[id, :]]
+            area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+            segment_info[new_instance_id] = dict(
+                id=new_instance_id,
+                category_id=class_id[id],
+                bbox=bbox,
+                iscrowd=0,
+                area=area,
+                isthing=True,
+            )
+            if self.mask_format == "rle":
+                segment_info[new_instance_id]["segmentation"] = mask_to_rle(
+                    panoptic_image == new_instance_id
                 )
-                # Add new instance only if no significant overlapping previous instance
-                if iou < self.valid_iou or replace_instance != new_instance_id:
-                    bbox = [int(id) for id in boxes[id, :].numpy()]
-                    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
-                    segment_info[new_instance_id] = dict(
-                        id=new_instance_id,
-                        category_id=class_id[id],
-                        bbox=bbox,
-                        iscrowd=0,
-                        area=area,
-                        isthing=True,
-                    )
-                    panoptic_image[new_instance_mask == 1] = new_instance_id
-                    valid_ids[new_instance_id] = id
-
-                # Remove previous overlapping instance
-                if iou > self.valid_iou and replace_instance != new_instance_id:
-                    segment_info.pop(replace_instance)
-                    valid_ids.pop(replace_instance)
-                    panoptic_image[panoptic_image == replace_instance] = 0
 
         assert list(segment_info.keys()) == list(np.unique(panoptic_image))[1:]
-        # convert panoptic image to RGB format
-        panoptic_image_id2rgb = np.zeros((masks.shape[1], masks.shape[2], 3)).astype(np.uint8)
-        panoptic_image_id2rgb[:, :, 0] = panoptic_image
-        save_ndarray_image(
-            os.path.join(self.panoptic_annotation_path, panoptic_filename),
-            panoptic_image_id2rgb,
-        )
         annotation["segments_info"] = list(segment_info.values())
         height, width = panoptic_image.shape
         image_info = dict(id=img_id, file_name=img_name, width=width, height=height)
-        json_filename = f"{img_id}.json"
-        json_filename = os.path.join(self.intermediate_json_path, json_filename)
-        write_json(
-            json_filename,
-            dict(annotations=[annotation], images=[image_info], categories=self.labels),
+        if self.mask_format == "rle":
+            # Segments carry their own masks instead of a panoptic png
+            del annotation["file_name"]
+            panoptic_image = None
+        json_info = dict(annotations=[annotation], images=[image_info], categories=self.labels)
+        if self.shard_writer is not None:
+            save = self._save_sample
+            outputs = (img_path, panoptic_image, json_info, on_written)
+        else:
+            save = self._save_outputs
+            outputs = (
+                os.path.join(self.panoptic_annotation_path, panoptic_filename),
+                panoptic_image,
+                self.annotation_json_path(img_path),
+                json_info,
+                on_written,
+            )
+        if self.writer is not None:
+            self.writer.submit(save, *outputs)
+        else:
+            save(*outputs)
+        return valid_ids
+
+    # Function to get the intermediate json file of an image
+    def annotation_json_path(self, image_path: str) -> str:
+        img_name = image_path.split("/")[-1]
+        img_id = ".".join(img_name.split(".")[:-1])
+        return os.path.join(self.intermediate_json_path, f"{img_id}.json")
+
+    # Function to run the models on an image, results are written by write_annotation
+    def predict_annotation(
+        self,
+        image_path: str,
+        box_threshold: float,
+        text_threshold: float,
+        image_array: Optional[np.ndarray] = None,
+    ) -> Dict:
+        return self._generate_image_labels(
+            image_path, box_threshold, text_threshold, image_array
         )
-        return list(valid_ids.values())
+
+    # Function to run the models on images in batches of batch_size
+    def predict_annotations(
+        self,
+        image_paths: List[str],
+        box_threshold: float,
+        text_threshold: float,
+        image_arrays: Optional[List[Optional[np.ndarray]]] = None,
+    ) -> List[Dict]:
+        image_arrays = image_arrays or [None] * len(image_paths)
+        batch_labels = []
+        for start in range(0, len(image_paths), self.batch_size):
+            batch_labels += self._generate_batch_labels(
+                image_paths[start : start + self.batch_size],
+                box_threshold,
+                text_threshold,
+                image_arrays[start : start + self.batch_size],
+            )
+        return batch_labels
+
+    # Function to write the results of predict_annotation, on_written runs once they are on disk
+    def write_annotation(
+        self, image_labels: Dict, on_written: Optional[Callable[[], None]] = None
+    ) -> np.ndarray:
+        return self._write_image_labels(image_labels, on_written)
 
     def generate_annotation(
         self, image_path: str, box_threshold: float, text_threshold: float
     ) -> np.ndarray:
-        labeled_image = self._generate_image_labels(image_path, box_threshold, text_threshold)
+        image_labels = self._generate_image_labels(image_path, box_threshold, text_threshold)
+        labeled_image = self._write_image_labels(image_labels)
         return labeled_image
 
+    def generate_annotations(
+        self, image_paths: List[str], box_threshold: float, text_threshold: float
+    ) -> List[np.ndarray]:
+        return [
+            self._write_image_labels(image_labels)
+            for image_labels in self.predict_annotations(
+                image_paths, box_threshold, text_threshold
+            )
+        ]
+
+    def clear_feature_cache(self):
+        if self.feature_cache is not None:
+            self.feature_cache.invalidate()
+
+    # Function to finish the outputs, waits for queued writes and closes the current shard
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+
     # Function to combine all intermediate jsons
     def combine_all_annotations(self):
+        if self.writer is not None:
+            self.writer.flush()
+        if self.shard_writer is not None:
+            # Shards of all writers of the dataset, e.g. of other annotation processes
+            ShardReader(self.shards_path).write_coco_json(self.final_annotation_file_name)
+            return
         combine_annotations_in_dir(
             self.intermediate_json_path, self.final_annotation_file_name
         )
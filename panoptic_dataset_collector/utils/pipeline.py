@@ -0,0 +1,385 @@
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from panoptic_dataset_collector.utils.annotation_pool import AnnotationPool
+from panoptic_dataset_collector.utils.crawler import Crawler, SearchError
+from panoptic_dataset_collector.utils.filter import Filter
+from panoptic_dataset_collector.utils.manifest import (
+    IMAGE_ANNOTATED,
+    IMAGE_EMPTY,
+    URL_DOWNLOADED,
+    URL_REJECTED,
+    RunManifest,
+)
+from panoptic_dataset_collector.utils.metrics import get_metrics
+from panoptic_dataset_collector.utils.panoptic_annotator import PanopticAnnotator
+from panoptic_dataset_collector.utils.profiler import HotPathProfiler
+
+_DONE = object()
+
+
+# Function to name an item in messages, images and masks are named by their path or url
+def _item_name(item: Any) -> str:
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict) and isinstance(item.get("img_path"), str):
+        return item["img_path"]
+    if isinstance(item, tuple) and len(item) > 0 and isinstance(item[0], str):
+        return item[0]
+    if isinstance(item, list):
+        return "[" + ", ".join(_item_name(part) for part in item) + "]"
+    return type(item).__name__
+
+
+class StageStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.queue_depth_sum = 0
+        self.max_queue_depth = 0
+        self.latencies: List[float] = []
+
+    def record(
+        self, queue_depth: int, seconds: float, items_out: int, error: bool, items_in: int = 1
+    ):
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.errors += int(error)
+            self.busy_seconds += seconds
+            self.queue_depth_sum += queue_depth
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            self.latencies.append(seconds)
+
+    # Function to get a percentile of the per item latencies in seconds
+    def latency_percentile(self, percentile: float) -> float:
+        with self._lock:
+            if not self.latencies:
+                return 0.0
+            return float(np.percentile(self.latencies, percentile))
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Iterable[Any]],
+        workers: int = 1,
+        queue_size: int = 8,
+        batch_size: int = 0,
+        max_latency: float = 0.0,
+    ):
+        # Checks
+        assert workers > 0 and queue_size > 0 and batch_size >= 0 and max_latency >= 0
+
+        # fn maps one input item to zero or more output items
+        # With a batch size, fn maps a list of up to batch_size items instead
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.stats = StageStats()
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]):
+        assert len(stages) > 0
+        self.stages = stages
+        self.wall_seconds = 0.0
+        self._stop = threading.Event()
+        self.metrics = get_metrics()
+
+    # Function to put an item in a bounded queue, gives up when the pipeline is stopped
+    def _put(self, out_queue: queue.Queue, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, in_queue: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    # Function to add items to a batch until it is full or max_latency passed since its first item
+    def _get_batch(self, stage: Stage, in_queue: queue.Queue, first: Any) -> List[Any]:
+        batch = [first]
+        deadline = time.perf_counter() + stage.max_latency
+        while len(batch) < stage.batch_size and not self._stop.is_set():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = in_queue.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                # Flush the partial batch, the end of the stream is seen on the next get
+                self._put(in_queue, _DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _feed(self, source: Iterable[Any], out_queue: queue.Queue):
+        for item in source:
+            if not self._put(out_queue, item):
+                return
+        self._put(out_queue, _DONE)
+
+    def _work(
+        self,
+        stage: Stage,
+        in_queue: queue.Queue,
+        out_queue: queue.Queue,
+        remaining: List[int],
+        lock: threading.Lock,
+    ):
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE:
+                # Let the sibling workers see the end of the stream as well
+                # A stopped pipeline has no end of stream to pass on and its queues may be full
+                if not self._stop.is_set():
+                    self._put(in_queue, _DONE)
+                break
+            queue_depth = in_queue.qsize()
+            items_in = 1
+            if stage.batch_size > 0:
+                item = self._get_batch(stage, in_queue, item)
+                items_in = len(item)
+            # Only the stage function is timed, time blocked on a full next queue is not busy time
+            # Outputs are still passed on one by one, so e.g. crawl streams urls of a page
+            seconds = 0.0
+            items_out = 0
+            error = False
+            stopped = False
+            try:
+                outputs = None
+                start = time.perf_counter()
+                while True:
+                    try:
+                        if outputs is None:
+                            outputs = iter(stage.fn(item))
+                        output = next(outputs)
+                    except StopIteration:
+                        break
+                    finally:
+                        seconds += time.perf_counter() - start
+                    if not self._put(out_queue, output):
+                        stopped = True
+                        break
+                    items_out += 1
+                    start = time.perf_counter()
+            except Exception as e:
+                error = True
+                print(f"Pipeline stage {stage.name} failed on {_item_name(item)}: {e}")
+            stage.stats.record(queue_depth, seconds, items_out, error, items_in)
+            self.metrics.observe("stage_seconds", seconds, stage=stage.name)
+            if error:
+                self.metrics.count("stage_errors", stage=stage.name)
+            if stopped:
+                return
+
+        # Last worker of a stage closes the next queue
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self._put(out_queue, _DONE)
+
+    # Function to stream the source through all stages and yield the outputs of the last
+    def run(self, source: Iterable[Any]) -> Iterator[Any]:
+        start = time.perf_counter()
+        for stage in self.stages:
+            stage.stats = StageStats()
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue(maxsize=self.stages[-1].queue_size))
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]), daemon=True)]
+        for id, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(stage, queues[id], queues[id + 1], remaining, lock),
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # Also stops the workers when the consumer stops early
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall_seconds = time.perf_counter() - start
+            self._stop.clear()
+
+    # Function to stop a running pipeline, run returns once the workers have stopped
+    # A pipeline stopped before it runs stops its next run right away
+    def stop(self):
+        self._stop.set()
+
+    def summary(self) -> str:
+        lines = [f"Pipeline finished in {self.wall_seconds:.1f}s"]
+        for stage in self.stages:
+            stats = stage.stats
+            throughput = stats.items_in / self.wall_seconds if self.wall_seconds else 0.0
+            mean_depth = stats.queue_depth_sum / stats.items_in if stats.items_in else 0.0
+            lines.append(
+                f"  {stage.name:<10} workers={stage.workers} in={stats.items_in} "
+                f"out={stats.items_out} errors={stats.errors} busy={stats.busy_seconds:.1f}s "
+                f"throughput={throughput:.2f}/s queue(mean={mean_depth:.1f}, "
+                f"max={stats.max_queue_depth}/{stage.queue_size})"
+            )
+        return "\n".join(lines)
+
+
+# Function to build the crawl, fetch, decode, inference and write stages of a collection run
+# With a manifest, work completed by previous runs is skipped and new work is recorded
+# With an annotation pool, inference and write run together in one stage per worker process
+def build_collection_pipeline(
+    crawler: Crawler,
+    filter: Filter,
+    annotator: Union[PanopticAnnotator, AnnotationPool],
+    box_threshold: float,
+    text_threshold: float,
+    fetch_workers: int = 16,
+    decode_workers: int = 2,
+    manifest: Optional[RunManifest] = None,
+    max_batch_latency: float = 0.5,
+    profiler: Optional[HotPathProfiler] = None,
+) -> Pipeline:
+    if manifest is not None:
+        # Files of previous runs keep their names
+        filter.reserved_paths.update(manifest.downloaded_paths())
+
+    # Image urls are streamed to the fetch stage while the page is still being crawled
+    # Pages are only recorded once searched, failed searches and the quota leave them pending
+    def crawl(start_id: int) -> Iterable[str]:
+        image_urls = manifest.page(start_id) if manifest is not None else None
+        if image_urls is not None:
+            yield from image_urls
+            return
+        image_urls = []
+        try:
+            for img_url in crawler.iter_crawl(start_id):
+                image_urls.append(img_url)
+                yield img_url
+        except SearchError as e:
+            print(f"{e}, skipping page {start_id}")
+            return
+        if manifest is not None:
+            manifest.add_page(start_id, image_urls)
+
+    def fetch(img_url: str) -> Iterable[Tuple[str, str]]:
+        if manifest is not None:
+            previous = manifest.url(img_url)
+            if previous is not None:
+                status, img_path = previous
+                if status == URL_REJECTED or manifest.image(img_path) is not None:
+                    return []
+                if os.path.isfile(img_path):
+                    return [(img_url, img_path)]
+        img_path = filter.download_image(img_url)
+        if img_path == "":
+            return []
+        if manifest is not None:
+            manifest.set_url(img_url, URL_DOWNLOADED, img_path)
+        return [(img_url, img_path)]
+
+    # With a decoder the image is decoded once here and handed to the model as an array
+    def decode(item: Tuple[str, str]) -> Iterable[Tuple[str, Optional[np.ndarray]]]:
+        img_url, img_path = item
+        image_array = None
+        if filter.decoder is not None:
+            image_array = filter.decode_image(img_path)
+            valid = image_array is not None
+        else:
+            valid = filter.filter_image(img_path)
+        if not valid:
+            if manifest is not None:
+                manifest.set_url(img_url, URL_REJECTED)
+            return []
+        print(f"Downloaded image {img_url}")
+        return [(img_path, image_array)]
+
+    # Images are annotated in batches of the annotator batch size
+    def inference(batch: List[Tuple[str, Optional[np.ndarray]]]) -> Iterable[Dict]:
+        with profiler.profile("annotation") if profiler is not None else nullcontext():
+            return annotator.predict_annotations(
+                [img_path for img_path, _ in batch],
+                box_threshold,
+                text_threshold,
+                [image_array for _, image_array in batch],
+            )
+
+    # The manifest is updated once the outputs are on disk, which may be after write returns
+    def write(image_labels: Dict) -> Iterable[Any]:
+        on_written = None
+        if manifest is not None:
+            img_path = image_labels["img_path"]
+            if len(image_labels["masks"]):
+                json_path = annotator.annotation_json_path(img_path)
+                on_written = lambda: manifest.set_image(img_path, IMAGE_ANNOTATED, json_path)
+            else:
+                on_written = lambda: manifest.set_image(img_path, IMAGE_EMPTY)
+        return [annotator.write_annotation(image_labels, on_written)]
+
+    def annotate(item: Tuple[str, Optional[np.ndarray]]) -> Iterable[np.ndarray]:
+        img_path, image_array = item
+        labeled_image, json_path = annotator.annotate(
+            img_path, box_threshold, text_threshold, image_array
+        )
+        if manifest is not None:
+            if json_path != "":
+                manifest.set_image(img_path, IMAGE_ANNOTATED, json_path)
+            else:
+                manifest.set_image(img_path, IMAGE_EMPTY)
+        return [labeled_image]
+
+    stages = [
+        Stage("crawl", crawl, workers=1, queue_size=2),
+        Stage("fetch", fetch, workers=fetch_workers, queue_size=4 * fetch_workers),
+        Stage("decode", decode, workers=decode_workers, queue_size=4 * decode_workers),
+    ]
+    if isinstance(annotator, AnnotationPool):
+        workers = annotator.num_workers
+        stages.append(Stage("annotate", annotate, workers=workers, queue_size=2 * workers))
+    else:
+        stages += [
+            # Small queue keeps the next image ready for the model without buffering many
+            Stage(
+                "inference",
+                inference,
+                workers=1,
+                queue_size=max(2, annotator.batch_size),
+                batch_size=annotator.batch_size,
+                max_latency=max_batch_latency,
+            ),
+            Stage("write", write, workers=1, queue_size=4),
+        ]
+    return Pipeline(stages)
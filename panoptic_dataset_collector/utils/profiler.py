@@ -0,0 +1,86 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+
+class HotPathProfiler:
+    def __init__(self, output_dir: str, torch_trace: bool = True, torch_trace_blocks: int = 3):
+        # Checks
+        assert output_dir is not None and output_dir != ""
+        assert torch_trace_blocks >= 0
+
+        # cProfile only sees the thread that enabled it, so every section has its own profile
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        # The torch profiler records every op of every thread while it runs, so it only traces
+        # the first blocks of each section, one block at a time
+        self.torch_trace = torch_trace
+        self.torch_trace_blocks = torch_trace_blocks
+        self._traced: Dict[str, int] = {}
+        self._trace_lock = threading.Lock()
+
+    # Function to trace the enclosed block with the torch profiler, writes a trace per block
+    @contextmanager
+    def _torch_trace(self, section: str) -> Iterator[None]:
+        with self._lock:
+            number = self._traced.get(section, 0)
+            trace = (
+                self.torch_trace
+                and number < self.torch_trace_blocks
+                and self._trace_lock.acquire(blocking=False)
+            )
+            if trace:
+                self._traced[section] = number + 1
+        if not trace:
+            yield
+            return
+        try:
+            import torch
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(
+                activities=activities, record_shapes=True
+            ) as torch_profiler:
+                yield
+            torch_profiler.export_chrome_trace(
+                os.path.join(self.output_dir, f"torch_trace_{section}_{number}.json")
+            )
+        finally:
+            self._trace_lock.release()
+
+    # Function to profile the enclosed block under a section name
+    @contextmanager
+    def profile(self, section: str) -> Iterator[None]:
+        with self._lock:
+            if section not in self._profiles:
+                self._profiles[section] = cProfile.Profile()
+            profile = self._profiles[section]
+        with self._torch_trace(section):
+            try:
+                profile.enable()
+            except ValueError:
+                # Newer Pythons allow a single active profiler, the block runs unprofiled
+                yield
+                return
+            try:
+                yield
+            finally:
+                profile.disable()
+
+    # Function to write the collected profiles, returns the cumulative time table of each section
+    def dump(self, top: int = 20) -> str:
+        tables = []
+        for section, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(self.output_dir, f"{section}.prof"))
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(top)
+            tables.append(f"Profile of {section}\n{stream.getvalue()}")
+        return "\n".join(tables)
@@ -0,0 +1,110 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+import torch
+
+from panoptic_dataset_collector.utils.utils import free_mem
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Function to get the resident memory of this process in MB
+def process_memory_mb() -> float:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0.0
+    # Peak instead of current resident memory, kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if os.uname().sysname == "Darwin" else peak / 2**10
+
+
+class ModelRuntime:
+    def __init__(self, memory_budget_mb: float = 0, device: str = "cpu"):
+        # Checks
+        assert memory_budget_mb >= 0
+
+        # Memory is only freed once the budget is exceeded, 0 never frees it
+        self.memory_budget_mb = memory_budget_mb
+        self.cuda = torch.device(device).type == "cuda"
+        self.peak_mb = 0.0
+        self.last_peak_mb = 0.0
+        self.frees = 0
+        self._after_free_mb = 0.0
+        # Buffers are per thread, so concurrent batches never share one
+        self._local = threading.local()
+        # Annotators sharing the models take turns, SAM holds the image of the current batch
+        self._lock = threading.Lock()
+
+    def memory_used_mb(self) -> float:
+        if self.cuda:
+            # Memory held by the caching allocator, which empty_cache releases
+            return torch.cuda.memory_reserved() / 2**20
+        return process_memory_mb()
+
+    # Function to run the enclosed model calls in inference mode and track their peak memory
+    @contextmanager
+    def session(self) -> Iterator[None]:
+        with self._lock:
+            if self.cuda:
+                torch.cuda.reset_peak_memory_stats()
+            start_mb = self.memory_used_mb()
+            try:
+                with torch.inference_mode():
+                    yield
+            finally:
+                if self.cuda:
+                    peak_mb = torch.cuda.max_memory_allocated() / 2**20
+                else:
+                    peak_mb = max(start_mb, self.memory_used_mb())
+                self.last_peak_mb = peak_mb
+                self.peak_mb = max(self.peak_mb, peak_mb)
+
+    # Function to free memory when the budget is exceeded, returns True if it was freed
+    # Memory that a free could not release does not trigger another free on every image
+    def maybe_free(self) -> bool:
+        if self.memory_budget_mb <= 0:
+            return False
+        used_mb = self.memory_used_mb()
+        threshold_mb = max(self.memory_budget_mb, self._after_free_mb * 1.1)
+        if used_mb <= threshold_mb:
+            return False
+        free_mem()
+        self.frees += 1
+        self._after_free_mb = self.memory_used_mb()
+        return True
+
+    # Function to get a reusable buffer of at least the given shape
+    # The returned tensor is only valid until the next call with the same name
+    def buffer(
+        self, name: str, shape: Tuple[int, ...], dtype: torch.dtype, device: torch.device
+    ) -> torch.Tensor:
+        buffers = self._local.__dict__.setdefault("buffers", {})
+        numel = 1
+        for size in shape:
+            numel *= size
+        flat = buffers.get(name)
+        if (
+            flat is None
+            or flat.numel() < numel
+            or flat.dtype != dtype
+            or flat.device != device
+        ):
+            flat = torch.empty(numel, dtype=dtype, device=device)
+            buffers[name] = flat
+        return flat[:numel].view(shape)
+
+    def stats(self) -> Dict[str, float]:
+        return dict(
+            memory_peak_mb=round(self.peak_mb, 1),
+            memory_last_peak_mb=round(self.last_peak_mb, 1),
+            memory_frees=self.frees,
+        )
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from panoptic_dataset_collector.utils.io import read_json, write_json
+
+
+class SearchCache:
+    def __init__(self, cache_dir: str, ttl_seconds: float = 7 * 24 * 3600):
+        # Checks
+        assert cache_dir is not None and cache_dir != ""
+        assert ttl_seconds > 0
+
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Function to get the cache file of a search, the api key is not part of the key
+    def _cache_file(self, params: Dict) -> str:
+        key = {name: params.get(name) for name in ["cx", "q", "searchType", "rights", "start"]}
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def get(self, params: Dict) -> Optional[Dict]:
+        cache_file = self._cache_file(params)
+        try:
+            cached = read_json(cache_file)
+            fresh = time.time() - cached["fetched_at"] < self.ttl_seconds
+        except (RuntimeError, ValueError, KeyError):
+            fresh = False
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return cached["response"] if fresh else None
+
+    def put(self, params: Dict, response: Dict):
+        cache_file = self._cache_file(params)
+        tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        write_json(tmp_file, dict(fetched_at=time.time(), response=response))
+        os.replace(tmp_file, cache_file)
@@ -27,6 +27,7 @@ class ServeGradioIterative(LightningWork, abc.ABC):
     examples: Optional[List] = None
     title: Optional[str] = None
     description: Optional[str] = None
+    concurrency_count: int = 1
 
     _start_method = "spawn"
 
@@ -46,7 +47,13 @@ class ServeGradioIterative(LightningWork, abc.ABC):
     def predict(self, *args: Any, **kwargs: Any):
         """Override with your logic to make a prediction."""
 
+    @abc.abstractmethod
+    def build_model(self) -> Any:
+        """Override to instantiate and return your model, built once before serving."""
+
     def run(self, *args: Any, **kwargs: Any):
+        if self._model is None:
+            self._model = self.build_model()
         self.ready = True
         demo = gradio.Interface(
             fn=self.predict,
@@ -56,7 +63,7 @@ class ServeGradioIterative(LightningWork, abc.ABC):
             title=self.title,
             description=self.description,
         )
-        demo.queue()
+        demo.queue(concurrency_count=self.concurrency_count)
         demo.launch(
             server_name=self.host,
             server_port=self.port,
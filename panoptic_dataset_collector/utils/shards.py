@@ -0,0 +1,177 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SHARD_NAME = "shard-{:06d}.tar"
+INDEX_FILE = "index.jsonl"
+# Suffix of the panoptic png member, the image member keeps the image extension
+PANOPTIC_SUFFIX = "panoptic.png"
+
+
+class ShardWriter:
+    def __init__(self, shard_dir: str, max_shard_mb: float = 1024):
+        # Checks
+        assert shard_dir is not None and shard_dir != ""
+        assert max_shard_mb > 0
+
+        # Samples are appended to tar shards and indexed with the byte offsets of their members
+        # Every writer claims new shards, so writers of several processes never share one
+        self.shard_dir = shard_dir
+        self.max_shard_bytes = int(max_shard_mb * 2**20)
+        self.index_file = os.path.join(shard_dir, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._file = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._shard_name = ""
+        self._next_number = 0
+        os.makedirs(shard_dir, exist_ok=True)
+
+    # Function to start the next unused shard, an exclusive create is atomic across processes
+    def _next_shard(self):
+        self._close_shard()
+        while True:
+            self._shard_name = SHARD_NAME.format(self._next_number)
+            self._next_number += 1
+            try:
+                self._file = open(os.path.join(self.shard_dir, self._shard_name), "xb")
+                break
+            except FileExistsError:
+                continue
+        self._tar = tarfile.open(fileobj=self._file, mode="w", format=tarfile.GNU_FORMAT)
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._file.close()
+            self._tar = None
+            self._file = None
+
+    # Function to append the files of a sample, named <key>.<suffix> in the shard
+    def write(self, key: str, files: Dict[str, bytes]):
+        with self._lock:
+            if self._tar is None or self._tar.offset >= self.max_shard_bytes:
+                self._next_shard()
+            members = {}
+            for suffix, data in files.items():
+                info = tarfile.TarInfo(f"{key}.{suffix}")
+                info.size = len(data)
+                info.mtime = int(time.time())
+                self._tar.addfile(info, io.BytesIO(data))
+                # Data is padded to whole tar blocks
+                padded = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                members[suffix] = [self._tar.offset - padded, len(data)]
+            # End of archive blocks after every sample keep the shard a valid tar if the run
+            # stops, the next sample overwrites them
+            self._file.write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+            self._file.seek(self._tar.offset)
+            self._file.flush()
+            with open(self.index_file, "a") as f:
+                f.write(
+                    json.dumps(dict(key=key, shard=self._shard_name, members=members)) + "\n"
+                )
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+
+
+class ShardReader:
+    def __init__(self, shard_dir: str):
+        # Checks
+        assert shard_dir is not None and shard_dir != ""
+
+        # A sample written again, e.g. by a resumed run, replaces the earlier one
+        self.shard_dir = shard_dir
+        self.entries: Dict[str, Dict] = {}
+        index_file = os.path.join(shard_dir, INDEX_FILE)
+        if os.path.isfile(index_file):
+            with open(index_file, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def keys(self) -> List[str]:
+        return list(self.entries)
+
+    # Function to read one member of a sample without reading the rest of its shard
+    def read(self, key: str, suffix: str) -> bytes:
+        entry = self.entries[key]
+        offset, size = entry["members"][suffix]
+        with open(os.path.join(self.shard_dir, entry["shard"]), "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    # Function to iterate over the samples shard by shard in file order, so reads are sequential
+    def samples(
+        self, suffixes: Optional[List[str]] = None
+    ) -> Iterator[Tuple[str, Dict[str, bytes]]]:
+        by_shard: Dict[str, List[Dict]] = {}
+        for entry in self.entries.values():
+            by_shard.setdefault(entry["shard"], []).append(entry)
+        for shard in sorted(by_shard):
+            entries = sorted(
+                by_shard[shard], key=lambda entry: min(m[0] for m in entry["members"].values())
+            )
+            with open(os.path.join(self.shard_dir, shard), "rb") as f:
+                for entry in entries:
+                    files = {}
+                    members = sorted(entry["members"].items(), key=lambda member: member[1][0])
+                    for suffix, (offset, size) in members:
+                        if suffixes is None or suffix in suffixes:
+                            f.seek(offset)
+                            files[suffix] = f.read(size)
+                    yield entry["key"], files
+
+    # Function to write the COCO json of all samples, streaming their per image jsons
+    # Returns the number of images
+    def write_coco_json(self, final_json_filename: str) -> int:
+        images = []
+        categories = []
+        annotations = 0
+        tmp_filename = f"{final_json_filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            f.write('{"annotations": [')
+            for _, files in self.samples(["json"]):
+                json_info = json.loads(files["json"])
+                for annotation in json_info["annotations"]:
+                    f.write(("," if annotations else "") + json.dumps(annotation))
+                    annotations += 1
+                images += json_info["images"]
+                categories = categories or json_info["categories"]
+            f.write('], "images": ')
+            f.write(json.dumps(images))
+            f.write(', "categories": ')
+            f.write(json.dumps(categories))
+            f.write("}")
+        os.replace(tmp_filename, final_json_filename)
+        return len(images)
+
+    # Function to unpack the samples into the COCO panoptic layout of the file output
+    # Returns the number of images
+    def export_coco(self, output_folder: str) -> int:
+        images_path = os.path.join(output_folder, "images")
+        panoptic_path = os.path.join(output_folder, "panoptic_annotation")
+        os.makedirs(images_path, exist_ok=True)
+        os.makedirs(panoptic_path, exist_ok=True)
+        for _, files in self.samples():
+            json_info = json.loads(files.pop("json"))
+            panoptic_png = files.pop(PANOPTIC_SUFFIX, None)
+            if panoptic_png is not None:
+                file_name = json_info["annotations"][0]["file_name"]
+                with open(os.path.join(panoptic_path, file_name), "wb") as f:
+                    f.write(panoptic_png)
+            # The remaining member is the image
+            for data in files.values():
+                with open(
+                    os.path.join(images_path, json_info["images"][0]["file_name"]), "wb"
+                ) as f:
+                    f.write(data)
+        return self.write_coco_json(os.path.join(output_folder, "panoptic_annotation.json"))
@@ -1,53 +1,76 @@
 import gc
 import os
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import requests
-import torch
 from PIL import Image
 
-from panoptic_dataset_collector.utils.io import read_json, write_json, write_yaml
+from panoptic_dataset_collector.utils.annotation_merger import AnnotationMerger
+from panoptic_dataset_collector.utils.http_client import HttpClient, get_default_client
+from panoptic_dataset_collector.utils.io import write_yaml
+
+# pycocotools compresses RLE masks when it is installed
+try:
+    from pycocotools import mask as mask_utils
+except ImportError:
+    mask_utils = None
 
 VALID_EXTENSIONS = [".png", ".jpg", ".jpeg"]
 
 
-def safe_requests(image_url: str, connection_timeout: int = 5) -> bool:
+# Function to open a single streamed response, the body is only read by the caller
+def fetch_url(
+    url: str, connection_timeout: float = 5, client: Optional[HttpClient] = None
+) -> Optional[requests.Response]:
+    client = client or get_default_client()
     try:
-        requests.get(image_url, timeout=connection_timeout)
-        return True
+        return client.get(url, timeout=connection_timeout, stream=True)
     except:
+        return None
+
+
+def safe_requests(
+    image_url: str, connection_timeout: float = 5, client: Optional[HttpClient] = None
+) -> bool:
+    response = fetch_url(image_url, connection_timeout, client)
+    if response is None:
         return False
+    # Reachable, release the connection without downloading the body
+    response.close()
+    return True
 
 
-def combine_annotations_in_dir(intermediate_json_dir: str, final_json_filename: str):
-    intermediate_json_files = os.listdir(intermediate_json_dir)
-    annotations = []
-    images_info = []
-    for json_file in intermediate_json_files:
-        json_info = read_json(os.path.join(intermediate_json_dir, json_file))
-        annotations.append(json_info["annotations"])
-        images_info.append(json_info["images"])
-    write_json(
-        final_json_filename,
-        dict(annotations=annotations, images=images_info, categories=json_info["categories"]),
-    )
+# Function to merge new intermediate jsons into the final COCO json
+def combine_annotations_in_dir(
+    intermediate_json_dir: str, final_json_filename: str, workers: int = 0
+) -> int:
+    merger = AnnotationMerger(intermediate_json_dir, final_json_filename, workers)
+    try:
+        return merger.merge()
+    finally:
+        merger.close()
 
 
-def resize_image_keep_aspect_ratio(image: Image, size: List[int]) -> Image:
-    old_width, old_height = image.size
+def get_resized_size(old_width: int, old_height: int, size: List[int]) -> Tuple[int, int]:
     if old_width > size[0]:
         new_width = size[0]
         new_height = int(size[0] * old_height / old_width)
     else:
         new_height = size[1]
         new_width = int(size[1] * old_width / old_height)
+    return new_width, new_height
+
 
-    resized_image = image.resize((new_width, new_height), Image.BILINEAR)
+def resize_image_keep_aspect_ratio(image: Image, size: List[int]) -> Image:
+    resized_image = image.resize(get_resized_size(*image.size, size), Image.BILINEAR)
     return resized_image
 
 
 def free_mem() -> None:
+    # torch is imported here so the network helpers of this module stay light
+    import torch
+
     # Free unused cuda memory before tracing
     # This allows Tensor-RT to use different compression tactics
     gc.collect()
@@ -71,6 +94,36 @@ def make_label_file(class_labels: List[str], search_key: str) -> str:
     return key
 
 
+# Function to map the phrases of a combined grounding prompt back to label ids
+def map_phrases_to_labels(phrases: List[str], label_names: List[str]) -> List[int]:
+    names = [name.lower().strip() for name in label_names]
+    # Prefer the longest label contained in a phrase, e.g. "polar bear" over "bear"
+    by_length = sorted(range(len(names)), key=lambda id: -len(names[id]))
+    label_ids = []
+    for phrase in phrases:
+        phrase = phrase.lower().strip()
+        label_id = -1
+        if phrase == "":
+            # An empty phrase is contained in every label, it names none of them
+            label_ids.append(label_id)
+            continue
+        if phrase in names:
+            label_id = names.index(phrase)
+        else:
+            for id in by_length:
+                if names[id] in phrase or phrase in names[id]:
+                    label_id = id
+                    break
+        if label_id < 0:
+            # Fall back to the label sharing most words with the phrase
+            words = set(phrase.split())
+            overlaps = [len(words & set(name.split())) for name in names]
+            if max(overlaps, default=0) > 0:
+                label_id = int(np.argmax(overlaps))
+        label_ids.append(label_id)
+    return label_ids
+
+
 def get_intersection_ratio(
     instance_id_mask: np.ndarray, mask: np.ndarray, current_instance_id: int
 ) -> Tuple[float, int]:
@@ -95,3 +148,109 @@ def get_intersection_ratio(
     if area_overlapping_instance < area_current_instance:
         remove_instance_id = overlapping_instance_id
     return (intersection_ratio, remove_instance_id)
+
+
+# Function to get the (y0, y1, x0, x1) bounding slices of every mask
+def get_mask_bounds(masks: np.ndarray) -> np.ndarray:
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    bounds = np.zeros((masks.shape[0], 4), dtype=np.int64)
+    bounds[:, 0] = rows.argmax(axis=1)
+    bounds[:, 1] = masks.shape[1] - rows[:, ::-1].argmax(axis=1)
+    bounds[:, 2] = cols.argmax(axis=1)
+    bounds[:, 3] = masks.shape[2] - cols[:, ::-1].argmax(axis=1)
+    return bounds
+
+
+# Function to resolve overlapping instances with the rules of get_intersection_ratio
+# Instances are added in order, instance i gets id i + 1 in the returned panoptic image
+def resolve_instance_overlaps(
+    masks: np.ndarray, valid_mask: int, valid_iou: float
+) -> Tuple[np.ndarray, List[int]]:
+    num_instances, height, width = masks.shape
+    masks = masks.astype(bool, copy=False)
+    areas = np.count_nonzero(masks.reshape(num_instances, height * width), axis=1)
+    bounds = get_mask_bounds(masks)
+
+    # Pairwise overlap of the mask bounds of all instances in one batched comparison
+    overlaps = (
+        (bounds[:, None, 0] < bounds[None, :, 1])
+        & (bounds[None, :, 0] < bounds[:, None, 1])
+        & (bounds[:, None, 2] < bounds[None, :, 3])
+        & (bounds[None, :, 2] < bounds[:, None, 3])
+    )
+
+    panoptic_image = np.zeros((height, width), dtype=np.int32)
+    visible_area = np.zeros(num_instances + 1, dtype=np.int64)
+    valid_ids = dict()
+    for id in range(num_instances):
+        new_instance_id = id + 1
+        area_current_instance = areas[id]
+        if area_current_instance <= valid_mask:
+            continue
+        y0, y1, x0, x1 = bounds[id]
+        region = panoptic_image[y0:y1, x0:x1]
+        mask = masks[id, y0:y1, x0:x1]
+
+        iou, replace_instance = 0.0, 0
+        counts = None
+        if overlaps[id, :id].any():
+            counts = np.bincount(region[mask], minlength=new_instance_id)
+            intersection = area_current_instance - counts[0]
+            if intersection > 0:
+                overlapping_instance_id = int(np.argmax(counts[1:new_instance_id])) + 1
+                area_overlapping_instance = visible_area[overlapping_instance_id]
+                iou = intersection / np.minimum(
+                    area_overlapping_instance, area_current_instance
+                )
+                replace_instance = new_instance_id
+                if area_overlapping_instance < area_current_instance:
+                    replace_instance = overlapping_instance_id
+
+        # Add new instance only if no significant overlapping previous instance
+        if iou < valid_iou or replace_instance != new_instance_id:
+            if counts is not None:
+                visible_area[: len(counts)] -= counts
+                visible_area[0] = 0
+            region[mask] = new_instance_id
+            visible_area[new_instance_id] = area_current_instance
+            valid_ids[new_instance_id] = id
+
+        # Remove previous overlapping instance
+        if iou > valid_iou and replace_instance != new_instance_id:
+            valid_ids.pop(replace_instance)
+            ry0, ry1, rx0, rx1 = bounds[replace_instance - 1]
+            replace_region = panoptic_image[ry0:ry1, rx0:rx1]
+            replace_region[replace_region == replace_instance] = 0
+            visible_area[replace_instance] = 0
+
+    return panoptic_image, list(valid_ids.values())
+
+
+# Function to encode panoptic ids as COCO RGB, id = R + 256 * G + 256 * 256 * B
+def id2rgb(id_map: np.ndarray) -> np.ndarray:
+    # The three low bytes of each little endian id are its R, G and B values
+    ids = np.ascontiguousarray(id_map, dtype="<i4")
+    rgb = np.empty(id_map.shape + (3,), dtype=np.uint8)
+    rgb[...] = ids.view(np.uint8).reshape(ids.shape + (4,))[..., :3]
+    return rgb
+
+
+def rgb2id(rgb: np.ndarray) -> np.ndarray:
+    rgb = rgb.astype(np.uint32)
+    return rgb[..., 0] + 256 * rgb[..., 1] + 256 * 256 * rgb[..., 2]
+
+
+# Function to encode a binary mask as COCO RLE, compressed when pycocotools is installed
+def mask_to_rle(mask: np.ndarray) -> Dict:
+    if mask_utils is not None:
+        rle = mask_utils.encode(np.asfortranarray(mask, dtype=np.uint8))
+        rle["counts"] = rle["counts"].decode()
+        return rle
+    # Uncompressed RLE counts are run lengths in column major order starting with zeros
+    pixels = mask.ravel(order="F")
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    runs = np.diff(np.concatenate([[0], changes, [pixels.size]]))
+    if pixels[0]:
+        runs = np.concatenate([[0], runs])
+    return dict(size=list(mask.shape), counts=runs.tolist())
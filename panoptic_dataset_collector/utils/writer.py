@@ -0,0 +1,42 @@
+import queue
+import threading
+from typing import Any, Callable
+
+
+class AsyncWriter:
+    def __init__(self, max_pending: int = 16):
+        # Checks
+        assert max_pending > 0
+
+        # Bounded queue limits the memory held by outputs waiting to be written
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.failures = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                self.failures += 1
+                print(f"Writing outputs failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    # Function to queue a write job, blocks while max_pending jobs are waiting
+    def submit(self, fn: Callable[..., Any], *args: Any):
+        self._queue.put((fn, args))
+
+    # Function to wait until all queued jobs are written
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,42 @@
+import os
+import tarfile
+
+import numpy as np
+
+from benchmarks.stub_model import StubAnnotator
+from benchmarks.suite import make_label_file
+from panoptic_dataset_collector.utils.shards import ShardReader
+
+
+# Closing the annotator writes the queued outputs and finishes the last shard
+def test_close_finishes_async_shard_writes(tmp_path):
+    download_folder = str(tmp_path / "dataset")
+    annotator = StubAnnotator(
+        download_folder,
+        make_label_file(str(tmp_path)),
+        async_write=True,
+        output_format="shards",
+        visualize=False,
+        stub_runner_args=dict(grounding_seconds=0, segmentation_seconds=0, instances=3),
+    )
+    img_paths = []
+    for id in range(4):
+        img_path = os.path.join(download_folder, f"image_{id}.jpg")
+        with open(img_path, "wb") as f:
+            f.write(b"jpeg")
+        img_paths.append(img_path)
+    image_array = np.zeros((64, 64, 3), dtype=np.uint8)
+    for image_labels in annotator.predict_annotations(
+        img_paths, 0.3, 0.25, [image_array] * len(img_paths)
+    ):
+        annotator.write_annotation(image_labels)
+    writer = annotator.writer
+    annotator.close()
+    assert not writer._thread.is_alive()
+    reader = ShardReader(annotator.shards_path)
+    assert sorted(reader.keys()) == [f"image_{id}" for id in range(4)]
+    for shard in os.listdir(annotator.shards_path):
+        if shard.endswith(".tar"):
+            with tarfile.open(os.path.join(annotator.shards_path, shard)) as tar:
+                assert len(tar.getnames()) == 4 * 3
+    assert reader.read("image_0", "jpg") == b"jpeg"
@@ -0,0 +1,49 @@
+import threading
+import warnings
+
+import numpy as np
+import torch
+
+from panoptic_dataset_collector.utils.feature_cache import FeatureCache
+
+
+# Cached arrays are mapped from disk and become tensors without a copy
+def test_get_maps_arrays(tmp_path):
+    cache = FeatureCache(str(tmp_path), "vit_b", 16)
+    features = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    cache.put("hash", "sam", dict(features=features), dict(input_size=[3, 4]))
+    arrays, meta = cache.get("hash", "sam")
+    assert isinstance(arrays["features"], np.memmap)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        tensor = torch.from_numpy(arrays["features"])
+    assert np.shares_memory(tensor.numpy(), arrays["features"])
+    assert np.array_equal(tensor.numpy(), features)
+    assert meta == dict(input_size=[3, 4])
+
+
+def test_hits_and_misses_of_concurrent_gets(tmp_path):
+    cache = FeatureCache(str(tmp_path), "vit_b", 16)
+    cache.put("hash", "sam", dict(features=np.zeros(4)))
+
+    def get():
+        for _ in range(200):
+            cache.get("hash", "sam")
+            cache.get("other", "sam")
+
+    threads = [threading.Thread(target=get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.hits == cache.misses == 800
+
+
+# Eviction removes the least recently used entries below the size cap
+def test_evicts_least_recently_used(tmp_path):
+    cache = FeatureCache(str(tmp_path), "vit_b", 1)
+    for id in range(6):
+        cache.put(f"hash{id}", "sam", dict(features=np.zeros(256 * 256, dtype=np.float32)))
+    assert cache._size <= cache.max_size
+    assert cache.get("hash5", "sam") is not None
+    assert cache.get("hash0", "sam") is None
@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import Counter
+
+from panoptic_dataset_collector.utils.fetcher import ConcurrentFetcher
+
+
+# Urls of a host at its limit wait without holding pool threads, other hosts keep fetching
+def test_busy_host_leaves_threads_to_other_hosts():
+    lock = threading.Lock()
+    active = Counter()
+    peaks = Counter()
+
+    def fetch(url: str) -> str:
+        host = url.split("/")[2]
+        with lock:
+            active[host] += 1
+            peaks[host] = max(peaks[host], active[host])
+        time.sleep(0.2 if host == "busy.com" else 0.01)
+        with lock:
+            active[host] -= 1
+        return url
+
+    fetcher = ConcurrentFetcher(max_workers=4, max_per_host=1, max_in_flight=16)
+    busy = [fetcher.submit(fetch, f"http://busy.com/{id}.jpg") for id in range(6)]
+    start = time.perf_counter()
+    other = fetcher.submit(fetch, "http://other.com/0.jpg")
+    assert other.result(timeout=5) == "http://other.com/0.jpg"
+    assert time.perf_counter() - start < 0.15
+    assert [future.result(timeout=5) for future in busy] == [
+        f"http://busy.com/{id}.jpg" for id in range(6)
+    ]
+    assert peaks["busy.com"] == 1
+    fetcher.close()
+
+
+def test_map_keeps_order_and_errors():
+    def fetch(url: str) -> str:
+        if url.endswith("bad"):
+            raise ValueError(url)
+        return url.upper()
+
+    fetcher = ConcurrentFetcher(max_workers=2, max_per_host=1, max_in_flight=2)
+    urls = [f"http://host{id % 3}.com/{id}" for id in range(20)]
+    assert fetcher.map(fetch, urls) == [url.upper() for url in urls]
+    future = fetcher.submit(fetch, "http://host0.com/bad")
+    assert isinstance(future.exception(timeout=5), ValueError)
+    fetcher.close()
@@ -0,0 +1,90 @@
+import time
+
+from benchmarks.stand_in_server import StandInServer
+from benchmarks.stub_model import StubRunner
+from panoptic_dataset_collector.utils import jobs
+from panoptic_dataset_collector.utils.pipeline import build_collection_pipeline
+from panoptic_dataset_collector.utils.runtime import ModelRuntime
+
+
+class StubHost(jobs.ModelHost):
+    def _load(self, sam_type: str):
+        time.sleep(0.5)
+        return StubRunner(["tiger"], 0.2, 0.2, instances=2), ModelRuntime()
+
+    def runner(self, sam_type: str, feature_cache=None):
+        stub, runtime = self.preload(sam_type).result()
+        return runtime, stub
+
+
+# Cancelling a running job stops its pipeline and releases the job and the queue
+def test_cancel_running_job(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    # Labels are drawn with lang_sam, the stub model runs without it
+    monkeypatch.setattr(
+        jobs.PanopticAnnotator, "_draw_labels", lambda self, image_array, *args: image_array
+    )
+    with StandInServer(pages=1, deep_images=0, image_size=(640, 480)) as server:
+
+        class StandInCrawler(jobs.Crawler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.url = server.search_url()
+
+        monkeypatch.setattr(jobs, "Crawler", StandInCrawler)
+        job_queue = jobs.JobQueue(workers=1, model_host=StubHost())
+        job = job_queue.submit(
+            "tigers", ["tiger"], "key", "engine", search_pages=1, dataset_root=str(tmp_path)
+        )
+        deadline = time.time() + 30
+        while job.images_done == 0 and not job.finished and time.time() < deadline:
+            time.sleep(0.05)
+        assert job.state == jobs.JOB_RUNNING
+        job.cancel()
+        assert job.wait(10)
+        assert job.state == jobs.JOB_CANCELLED
+        assert job.images_done < 10
+        # The folder lock is released, a later job of the same folder runs
+        next_job = job_queue.submit(
+            "tigers", ["tiger"], "key", "engine", search_pages=1, dataset_root=str(tmp_path)
+        )
+        next_job.cancel()
+        assert next_job.wait(10)
+        job_queue.close()
+
+
+# A cancel while the job builds its pipeline stops the pipeline before it runs, and the
+# threads of the job are stopped when it ends
+def test_cancel_while_starting(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    # The jobs never search, their pipelines stop before running
+    monkeypatch.setattr(jobs.Crawler, "search", lambda self, start_id: {})
+    started = []
+
+    def build_and_cancel(crawler, filter, annotator, *args, **kwargs):
+        started.append((crawler, filter))
+        for job in list(job_queue.jobs.values()):
+            job.cancel()
+        return build_collection_pipeline(crawler, filter, annotator, *args, **kwargs)
+
+    monkeypatch.setattr(jobs, "build_collection_pipeline", build_and_cancel)
+    job_queue = jobs.JobQueue(workers=1, model_host=StubHost(), max_finished_jobs=1)
+    job = job_queue.submit(
+        "tigers", ["tiger"], "key", "engine", search_pages=1, dataset_root=str(tmp_path)
+    )
+    assert job.wait(10)
+    assert job.state == jobs.JOB_CANCELLED
+    assert job.pipeline.stages[0].stats.items_in == 0
+    crawler, filter = started[0]
+    assert crawler._executor._shutdown and filter.fetcher._executor._shutdown
+    # Only the latest finished job is kept
+    next_job = job_queue.submit(
+        "lions", ["lion"], "key", "engine", search_pages=1, dataset_root=str(tmp_path)
+    )
+    assert next_job.wait(10)
+    deadline = time.time() + 10
+    while len(job_queue.jobs) > 1 and time.time() < deadline:
+        time.sleep(0.05)
+    assert list(job_queue.jobs) == [next_job.id]
+    assert job_queue._folder_locks == {}
+    job_queue.close()
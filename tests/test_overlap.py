@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from benchmarks.overlap_resolution import legacy_resolve, make_masks
+from panoptic_dataset_collector.utils.utils import resolve_instance_overlaps
+
+
+def _assert_same_as_legacy(masks: np.ndarray, valid_mask: int, valid_iou: float):
+    legacy_image, legacy_ids = legacy_resolve(masks, valid_mask, valid_iou)
+    panoptic_image, valid_ids = resolve_instance_overlaps(masks, valid_mask, valid_iou)
+    assert valid_ids == legacy_ids
+    assert np.array_equal(panoptic_image, legacy_image)
+
+
+# The vectorized resolution keeps the instances and ids of the per instance loop it replaced
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize(
+    "valid_mask,valid_iou", [(0, 0.6), (200, 0.3), (200, 0.6), (500, 0.9)]
+)
+def test_same_as_legacy(seed: int, valid_mask: int, valid_iou: float):
+    _assert_same_as_legacy(make_masks(40, 180, 240, seed), valid_mask, valid_iou)
+
+
+def test_no_masks():
+    _assert_same_as_legacy(np.zeros((0, 64, 80), dtype=bool), 0, 0.6)
+
+
+# Inner instances are replaced by or replace the instance around them depending on the order
+@pytest.mark.parametrize("valid_iou", [0.3, 0.6, 0.9])
+def test_nested_masks(valid_iou: float):
+    masks = np.zeros((4, 100, 100), dtype=bool)
+    masks[0, 10:90, 10:90] = True
+    masks[1, 30:70, 30:70] = True
+    masks[2, 40:60, 40:60] = True
+    masks[3] = masks[0]
+    _assert_same_as_legacy(masks, 10, valid_iou)
+    _assert_same_as_legacy(masks[::-1].copy(), 10, valid_iou)
+
+
+# Instances at or below the minimum area are dropped
+def test_small_masks():
+    masks = np.zeros((3, 50, 50), dtype=bool)
+    masks[0, :10, :10] = True
+    masks[1, 5:15, 5:15] = True
+    masks[2, 20:40, 20:40] = True
+    _assert_same_as_legacy(masks, 100, 0.6)
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import Iterable, List
+
+import numpy as np
+
+from panoptic_dataset_collector.utils.pipeline import Pipeline, Stage
+
+
+def _run_and_close_early(pipeline: Pipeline, source: Iterable[int], taken: List[int]):
+    outputs = pipeline.run(source)
+    taken.append(next(outputs))
+    outputs.close()
+
+
+# Function of a slow stage that drops all items but the first
+def _slow_filter(item: int) -> List[int]:
+    time.sleep(0.05)
+    return [item] if item == 0 else []
+
+
+# Closing run() early stops the workers even while their input queues are full
+def test_run_closed_early_returns():
+    pipeline = Pipeline(
+        [
+            Stage("filter", _slow_filter, workers=2, queue_size=2),
+            Stage("identity", lambda item: [item], workers=2, queue_size=2),
+        ]
+    )
+    taken = []
+    thread = threading.Thread(
+        target=_run_and_close_early, args=(pipeline, range(1000), taken), daemon=True
+    )
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert len(taken) == 1
+
+
+# Stopping a pipeline from another thread ends run() like the end of the source
+def test_stop_ends_run():
+    pipeline = Pipeline([Stage("identity", lambda item: [item], workers=2, queue_size=2)])
+    outputs = []
+
+    def consume():
+        for item in pipeline.run(iter(int, 1)):
+            outputs.append(item)
+            if len(outputs) == 5:
+                pipeline.stop()
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert len(outputs) >= 5
+
+
+# Batched stages flush their last partial batch and end with the source
+def test_batched_stage_sees_end_of_stream():
+    pipeline = Pipeline(
+        [Stage("sum", lambda batch: [sum(batch)], workers=2, batch_size=4, max_latency=1.0)]
+    )
+    assert sum(pipeline.run(range(10))) == sum(range(10))
+
+
+# A pipeline stopped before it runs stops that run only
+def test_stop_before_run():
+    pipeline = Pipeline([Stage("identity", lambda item: [item])])
+    pipeline.stop()
+    assert list(pipeline.run(range(100))) == []
+    assert list(pipeline.run(range(3))) == [0, 1, 2]
+
+
+# Time blocked on a full downstream queue is not counted as busy time of the stage
+def test_busy_time_excludes_blocked_puts():
+    def slow_sink(item: int) -> List[int]:
+        time.sleep(0.05)
+        return [item]
+
+    pipeline = Pipeline(
+        [
+            Stage("source", lambda item: [item], workers=1, queue_size=1),
+            Stage("sink", slow_sink, workers=1, queue_size=1),
+        ]
+    )
+    assert list(pipeline.run(range(20))) == list(range(20))
+    source, sink = pipeline.stages
+    assert source.stats.busy_seconds < 0.2
+    assert sink.stats.busy_seconds >= 20 * 0.05
+
+
+# Failed items are named by their path rather than printed whole
+def test_failed_item_is_named(capsys):
+    def fail(item):
+        raise ValueError("bad image")
+
+    pipeline = Pipeline([Stage("decode", fail)])
+    assert list(pipeline.run([("a.jpg", np.zeros((64, 64, 3)))])) == []
+    assert "Pipeline stage decode failed on a.jpg: bad image" in capsys.readouterr().out
+    assert pipeline.stages[0].stats.errors == 1